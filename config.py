@@ -70,9 +70,32 @@ def get_config(parse_args = True, cfg_path=None, init_logging=False):
     agentConfig = {
         'check_freq': DEFAULT_CHECK_FREQUENCY,
         'debug_mode': False,
+        'dogstatsd_adaptive_sampling_threshold': 0,
+        'dogstatsd_allow_prefixes': None,
+        'dogstatsd_batch_size': 1000,
+        'dogstatsd_buffer_size': 8192,
+        'dogstatsd_deny_prefixes': None,
         'dogstatsd_interval': 10,
+        'dogstatsd_max_contexts_per_metric': 0,
+        'dogstatsd_max_points_per_post': 1000,
+        'dogstatsd_max_post_size': 1024 * 1024,
+        'dogstatsd_max_tag_values': 0,
+        'dogstatsd_parse_cache_size': 10000,
         'dogstatsd_port': 8125,
+        'dogstatsd_so_rcvbuf': None,
+        'dogstatsd_socket': None,
+        'dogstatsd_socket_rcvbuf': None,
+        'dogstatsd_spool_dir': None,
+        'dogstatsd_spool_max_size': 64 * 1024 * 1024,
+        'dogstatsd_strip_tags': None,
+        'dogstatsd_use_gzip': True,
+        'dogstatsd_workers': 1,
         'dogstatsd_target': 'http://localhost:17123',
+        'forwarder_flush_rate': 0,
+        'forwarder_journal_dir': None,
+        'forwarder_journal_max_size': 64 * 1024 * 1024,
+        'forwarder_max_batch_size': 1024 * 1024,
+        'forwarder_max_in_flight': 4,
         'graphite_listen_port': None,
         'hostname': None,
         'listen_port': None,
@@ -136,6 +159,9 @@ def get_config(parse_args = True, cfg_path=None, init_logging=False):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
                 agentConfig['watchdog'] = False
 
+        if config.has_option('Main', 'dogstatsd_use_gzip'):
+            agentConfig['dogstatsd_use_gzip'] = config.get('Main', 'dogstatsd_use_gzip').lower() in ('yes', 'true')
+
         # Optional graphite listener
         if config.has_option('Main','graphite_listen_port'):
             agentConfig['graphite_listen_port'] = int(config.get('Main','graphite_listen_port'))
@@ -26,12 +26,13 @@ from tornado.escape import json_decode
 from tornado.options import define, parse_command_line, options
 
 # agent import
-from util import Watchdog
+from util import Watchdog, gzip_compress, gzip_decompress
 from emitter import http_emitter, format_body
 from config import get_config
 from checks.common import getUuid
 from checks import gethostname
 from transaction import Transaction, TransactionManager
+from journal import Journal
 
 TRANSACTION_FLUSH_INTERVAL = 5000 # Every 5 seconds
 WATCHDOG_INTERVAL_MULTIPLIER = 10 # 10x flush interval
@@ -42,13 +43,24 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024 # 30MB
 
-THROTTLING_DELAY = timedelta(microseconds=1000000/2) # 2 msg/second
+# Maximum number of transactions sent at once, waiting for a response
+MAX_IN_FLIGHT = 4
+
+# Maximum size of a post merging the series of several API transactions,
+# uncompressed
+MAX_BATCH_SIZE = 1024 * 1024 # 1MB
+
+# Maximum journal size in bytes, and delay between syncs of the journal
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024 # 64MB
+JOURNAL_SYNC_INTERVAL = 1 # seconds
 
 class MetricTransaction(Transaction):
 
     _application = None
     _trManager = None
 
+    JOURNAL_TYPE = 'M'
+
     @classmethod
     def set_application(cls, app):
         cls._application = app
@@ -62,24 +74,42 @@ class MetricTransaction(Transaction):
         return cls._trManager
 
     def __init__(self, data):
-        self._data = data
-
-        # Call after data has been set (size is computed in Transaction's init)
-        Transaction.__init__(self)
+        self.set_payload(gzip_compress(self.format_data(data)))
 
         # Insert the transaction in the Manager
         self._trManager.append(self)
         logging.debug("Created transaction %d" % self.get_id())
         self._trManager.flush()
 
+    def set_payload(self, payload):
+        # Only keep the payload as it will be sent, compressed: it's all we
+        # need to send it, and its size is what the transaction really costs
+        # the queue.
+        self._payload = payload
+
+        # Call after data has been set (size is computed in Transaction's init)
+        Transaction.__init__(self)
+
+    @classmethod
+    def from_journal(cls, payload):
+        """Build a transaction back from its journaled payload, without
+           inserting it in the Manager"""
+        tr = cls.__new__(cls)
+        tr.set_payload(payload)
+        return tr
+
+    def get_journal_record(self):
+        return self.JOURNAL_TYPE + self._payload
+
     def __sizeof__(self):
-        return sys.getsizeof(self._data)
+        return sys.getsizeof(self._payload)
+
+    def format_data(self, data):
+        """Serialize the data into the body to post"""
+        return format_body(data, logging)
 
     def get_data(self):
-        try:
-            return format_body(self._data, logging)
-        except:
-            logging.exception('http_emitter failed')
+        return gzip_decompress(self._payload)
 
     def get_url(self):
         return self._application._agentConfig['dd_url'] + '/intake/'
@@ -103,16 +133,115 @@ class MetricTransaction(Transaction):
         self._trManager.flush_next()
 
 
+def is_series_only(body):
+    """Whether a body only holds a list of series"""
+    try:
+        data = json_decode(body)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.keys() == ['series'] and \
+        isinstance(data['series'], list)
+
+def get_series_items(body):
+    """Return the text of the items of a series only body's list: it's all
+       between its first '[' and its last ']'"""
+    return body[body.index('[') + 1:body.rindex(']')].strip()
+
+
 class APIMetricTransaction(MetricTransaction):
 
+    _max_batch_size = MAX_BATCH_SIZE
+
+    JOURNAL_TYPE = 'A'
+
+    @classmethod
+    def set_max_batch_size(cls, size):
+        cls._max_batch_size = size
+
+    def __init__(self, data):
+        # The size of the body once merged with other transactions, and
+        # whether it can be: only bodies holding nothing but series can
+        self._batch_size = len(data)
+        self._series_only = is_series_only(data)
+        MetricTransaction.__init__(self, data)
+
+    def set_payload(self, payload):
+        # Payloads of the transactions merged into this one, compressed,
+        # and their ids
+        self._batch = []
+        self._batch_ids = []
+        MetricTransaction.set_payload(self, payload)
+
+    @classmethod
+    def from_journal(cls, payload):
+        tr = super(APIMetricTransaction, cls).from_journal(payload)
+        body = gzip_decompress(payload)
+        tr._batch_size = len(body)
+        tr._series_only = is_series_only(body)
+        return tr
+
+    def __sizeof__(self):
+        return MetricTransaction.__sizeof__(self) + \
+            sum(sys.getsizeof(payload) for payload in self._batch)
+
+    def is_mergeable(self):
+        return self._series_only
+
+    def merge(self, tr):
+        """Merge the series of another API transaction into this one's post,
+           up to the maximum batch size"""
+        if not isinstance(tr, APIMetricTransaction) or \
+                self._batch_size + tr._batch_size > self._max_batch_size or \
+                not self.is_mergeable() or not tr.is_mergeable():
+            return False
+
+        self._batch.append(tr._payload)
+        self._batch.extend(tr._batch)
+        self._batch_ids.append(tr.get_id())
+        self._batch_ids.extend(tr._batch_ids)
+        self._batch_size = self._batch_size + tr._batch_size
+        self._size = None
+        logging.debug("Transaction %d merged into transaction %d" %
+            (tr.get_id(), self.get_id()))
+        return True
+
+    def get_data(self):
+        if self._batch:
+            # Build the merged body once, it's sent again as is if it fails.
+            # The size the queue accounted for is kept, it's the sum of the
+            # parts. The bodies were checked when received, their series are
+            # joined without decoding them again.
+            items = [get_series_items(gzip_decompress(payload))
+                     for payload in [self._payload] + self._batch]
+            body = '{"series":[' + ','.join(item for item in items if item) + ']}'
+            self._payload = gzip_compress(body)
+            self._batch = []
+        return MetricTransaction.get_data(self)
+
+    def on_response(self, response):
+        if self._batch_ids:
+            logging.info("Transaction %d %s, with merged transactions %s" %
+                (self.get_id(), "failed" if response.error else "completed",
+                 ", ".join(str(tr_id) for tr_id in self._batch_ids)))
+        MetricTransaction.on_response(self, response)
+
     def get_url(self):
         config = self._application._agentConfig
         api_key = config['api_key']
         base_url = config['dd_url']
         return base_url + '/api/v1/series/?api_key=' + api_key
 
-    def get_data(self):
-        return self._data
+    def format_data(self, data):
+        # The data is the body received, already serialized
+        return data
+
+
+def load_transaction(record):
+    """Build a transaction back from its journal record"""
+    for cls in (MetricTransaction, APIMetricTransaction):
+        if record[:1] == cls.JOURNAL_TYPE:
+            return cls.from_journal(record[1:])
+    raise ValueError("Unknown journal record type %r" % record[:1])
 
 
 class StatusHandler(tornado.web.RequestHandler):
@@ -171,6 +300,8 @@ class ApiInputHandler(tornado.web.RequestHandler):
 
         # read message
         msg = self.request.body
+        if msg is not None and self.request.headers.get('Content-Encoding') == 'gzip':
+            msg = gzip_decompress(msg)
 
         if msg is not None:
             # Setup a transaction for this message
@@ -187,9 +318,32 @@ class Application(tornado.web.Application):
         self._metrics = {}
         self._watchdog = Watchdog(TRANSACTION_FLUSH_INTERVAL * WATCHDOG_INTERVAL_MULTIPLIER)
         MetricTransaction.set_application(self)
+
+        max_in_flight = int(agentConfig.get('forwarder_max_in_flight', MAX_IN_FLIGHT))
+        # By default there's no rate limit: the in-flight window bounds the
+        # load on the intake, and the replay goes as fast as the link allows.
+        flush_rate = float(agentConfig.get('forwarder_flush_rate', 0) or 0)
+        if flush_rate > 0:
+            throttling_delay = timedelta(seconds=1.0/flush_rate)
+        else:
+            throttling_delay = timedelta(seconds=0)
+
+        # Optional journal, to keep the transactions across restarts
+        self._journal = None
+        journal_dir = agentConfig.get('forwarder_journal_dir', None)
+        if journal_dir:
+            self._journal = Journal(journal_dir,
+                max_size=int(agentConfig.get('forwarder_journal_max_size', MAX_JOURNAL_SIZE)),
+                sync_interval=JOURNAL_SYNC_INTERVAL)
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-            MAX_QUEUE_SIZE, THROTTLING_DELAY)
+            MAX_QUEUE_SIZE, throttling_delay, max_in_flight=max_in_flight,
+            throttling_burst=max_in_flight, journal=self._journal)
         MetricTransaction.set_tr_manager(self._tr_manager)
+        APIMetricTransaction.set_max_batch_size(int(agentConfig.get(
+            'forwarder_max_batch_size', MAX_BATCH_SIZE)))
+        if self._journal is not None:
+            self._tr_manager.replay_journal(load_transaction)
    
     def appendMetric(self, prefix, name, host, device, ts, value):
         if self._metrics.has_key(prefix):
@@ -236,6 +390,8 @@ class Application(tornado.web.Application):
             self._watchdog.reset()
             self._postMetrics()
             self._tr_manager.flush()
+            if self._journal is not None:
+                self._journal.sync()
 
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs, TRANSACTION_FLUSH_INTERVAL, io_loop = mloop)
 
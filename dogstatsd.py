@@ -4,12 +4,22 @@ A Python Statsd implementation with some datadog special sauce.
 '''
 
 # stdlib
+from collections import deque
+import errno
+from hashlib import md5
 import httplib as http_client
 import logging
+import math
+from multiprocessing import Process, Queue
 import optparse
-from random import randrange
+import os
+from Queue import Empty
+from random import random, randrange
 import re
+import select
 import socket
+import stat
+import struct
 import sys
 import time
 import threading
@@ -18,196 +28,1146 @@ from urllib import urlencode
 # project
 from config import get_config
 from checks import gethostname
-from util import json
+from spool import Spool
+from util import json, gzip_compress
+
+try:
+    from json.encoder import encode_basestring_ascii as encode_json_string
+except ImportError:
+    encode_json_string = json.dumps
 
 logger = logging.getLogger('dogstatsd')
 
+# The largest payload a UDP datagram can carry.
+MAX_BUFFER_SIZE = 65535
+
+# Files listing the kernel's per-socket UDP counters (including drops).
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+# Python 2 doesn't expose SO_REUSEPORT, default to its value on Linux (which
+# supports it since 3.9).
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Timeouts (in seconds) to connect to the api host and to get its responses.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# How often (in seconds) sharded workers hand their completed intervals over
+# to the reporting process.
+WORKER_EXPORT_INTERVAL = 1
+
+def encode_json_number(value, float_repr=float.__repr__, dumps=json.dumps):
+    """ Encode a number the way json.dumps would, faster for ints and finite floats. """
+    cls = value.__class__
+    if cls is int:
+        return str(value)
+    if cls is float and value - value == 0:
+        return float_repr(value)
+    return dumps(value)
+
+
+def encode_json_tags(tags, encode_string=encode_json_string):
+    """ Encode a tags tuple (or None) the way json.dumps would. """
+    if tags is None:
+        return 'null'
+    return '[' + ','.join([encode_string(t) for t in tags]) + ']'
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There can be hundreds of thousands of live metrics, so they are kept as
+    small as possible: they use __slots__ and don't store their name, tags
+    or hostname, which are given by the aggregator when flushing.
     """
 
+    __slots__ = ()
+
+    # Parses the value of a metric line.
+    value_type = float
+    # Whether points can be dropped under load, the kept ones being weighted
+    # up. Adaptive metrics count their points in a `seen` slot.
+    adaptive = False
+
     def sample(self, value, sample_rate):
         """ Add a point to the given metric. """
         raise NotImplementedError()
 
-    def flush(self, timestamp):
+    def values(self):
+        """ Return the (name suffix, value) pairs of the points to flush. """
+        raise NotImplementedError()
+
+    def flush(self, timestamp, name, tags, hostname):
         """ Flush all metrics up to the given timestamp. """
+        return [{
+            'metric' : name + suffix,
+            'points' : [(timestamp, value)],
+            'tags' : tags,
+            'host' : hostname
+        } for suffix, value in self.values()]
+
+    def merge(self, other):
+        """ Merge the points of another metric of the same context. """
+        raise NotImplementedError()
+
+    def reset(self):
+        """ Forget the points, so the metric can be reused. """
         raise NotImplementedError()
 
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
 
-    def __init__(self, name, tags, hostname):
-        self.name = name
+    __slots__ = ('value',)
+
+    def __init__(self):
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
 
     def sample(self, value, sample_rate):
         self.value = value
 
-    def flush(self, timestamp):
-        return [{
-            'metric' : self.name,
-            'points' : [(timestamp, self.value)],
-            'tags' : self.tags,
-            'host' : self.hostname
-        }]
+    def merge(self, other):
+        if other.value is not None:
+            self.value = other.value
+
+    def reset(self):
+        self.value = None
+
+    def values(self):
+        return [('', self.value)]
 
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
 
-    def __init__(self, name, tags, hostname):
-        self.name = name
+    __slots__ = ('value', 'seen')
+
+    adaptive = True
+
+    def __init__(self):
         self.value = 0
-        self.tags = tags
-        self.hostname = hostname
+        self.seen = 0
 
     def sample(self, value, sample_rate):
-        self.value += value * int(1 / sample_rate)
+        self.value += value / sample_rate
 
-    def flush(self, timestamp):
-        return [{
-            'metric' : self.name,
-            'points' : [(timestamp, self.value)],
-            'tags' : self.tags,
-            'host' : self.hostname
-        }]
+    def merge(self, other):
+        self.value += other.value
+
+    def reset(self):
+        self.value = 0
+        self.seen = 0
+
+    def values(self):
+        return [('', self.value)]
+
+
+class QuantileSketch(object):
+    """
+    A bounded-memory quantile sketch, in the spirit of DDSketch.
+
+    Values are counted in buckets whose bounds grow geometrically, so any
+    quantile returned is within RELATIVE_ACCURACY (1%) of the value of the
+    exact rank, whatever the distribution. Memory is bounded by MAX_BUCKETS:
+    past it, the buckets closest to zero of the biggest store (positive or
+    negative values) are merged away from zero. Only the quantiles falling
+    among the values closest to zero lose accuracy: the smallest positive
+    values and the greatest negative ones, which are the lowest quantiles
+    when all values are positive, and the highest when all are negative.
+    Sketches can be merged without losing accuracy. Values can be weighted
+    (by the inverse of their sample rate), the counts are then fractional.
+    """
+
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MAX_BUCKETS = 2048
+    # Values closer to zero than this are counted as zero.
+    MIN_VALUE = 1e-9
+
+    __slots__ = ('positive', 'negative', 'zero_count', 'count')
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def clear(self):
+        """ Remove all the values of the sketch. """
+        self.positive.clear()
+        self.negative.clear()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, weight=1):
+        """ Add a value to the sketch, counted `weight` times. """
+        self.count += weight
+        if value > self.MIN_VALUE:
+            buckets = self.positive
+        elif value < -self.MIN_VALUE:
+            buckets = self.negative
+            value = -value
+        else:
+            self.zero_count += weight
+            return
+
+        key = int(math.ceil(math.log(value) / self.LOG_GAMMA))
+        if key in buckets:
+            buckets[key] += weight
+        else:
+            buckets[key] = weight
+            if len(self.positive) + len(self.negative) > self.MAX_BUCKETS:
+                self._collapse()
+
+    def merge(self, other):
+        """ Add the values of another sketch to this one. """
+        for buckets, other_buckets in ((self.positive, other.positive),
+                                       (self.negative, other.negative)):
+            for key, count in other_buckets.iteritems():
+                buckets[key] = buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        while len(self.positive) + len(self.negative) > self.MAX_BUCKETS:
+            self._collapse()
+
+    def _collapse(self):
+        # Merge the two buckets closest to zero of the biggest store.
+        if len(self.positive) >= len(self.negative):
+            buckets = self.positive
+        else:
+            buckets = self.negative
+        lowest = min(buckets)
+        count = buckets.pop(lowest)
+        next_lowest = min(buckets)
+        buckets[next_lowest] += count
+
+    def _bucket_value(self, key):
+        # The value at the middle (relative-error wise) of the bucket.
+        return 2 * self.GAMMA ** key / (self.GAMMA + 1)
+
+    def quantiles(self, quantiles):
+        """
+        Return the values at the given (sorted) quantiles. A quantile q is the
+        value ranked round(q * count - 1) among the values.
+        """
+        if not self.count:
+            return [None] * len(quantiles)
+
+        # Walk the buckets in increasing value order.
+        buckets = [(-self._bucket_value(k), self.negative[k])
+                   for k in sorted(self.negative, reverse=True)]
+        if self.zero_count:
+            buckets.append((0.0, self.zero_count))
+        buckets.extend((self._bucket_value(k), self.positive[k])
+                       for k in sorted(self.positive))
+
+        values = []
+        seen = 0
+        i = 0
+        last = len(buckets) - 1
+        for q in quantiles:
+            rank = max(int(round(q * self.count - 1)), 0)
+            # Weighted counts may not add up exactly to the total.
+            while i < last and seen + buckets[i][1] <= rank:
+                seen += buckets[i][1]
+                i += 1
+            values.append(buckets[i][0])
+        return values
 
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
 
-    def __init__(self, name, tags, hostname):
-        self.name = name
+    percentiles = [0.75, 0.85, 0.95, 0.99]
+    percentile_suffixes = map(lambda p: '.%spercentile' % int(p * 100), percentiles)
+
+    __slots__ = ('max', 'min', 'sum', 'count', 'sketch', 'seen')
+
+    adaptive = True
+
+    def __init__(self):
         self.max = float("-inf")
         self.min = float("inf")
         self.sum = 0
         self.count = 0
-        self.sample_size = 1000
-        self.samples = []
-        self.percentiles = [0.75, 0.85, 0.95, 0.99]
-        self.tags = tags
-        self.hostname = hostname
+        self.sketch = QuantileSketch()
+        self.seen = 0
 
     def sample(self, value, sample_rate):
-        self.count += int(1 / sample_rate)
-        self.samples.append(value)
+        weight = 1 / sample_rate
+        self.count += weight
+        self.sum += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sketch.add(value, weight)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def reset(self):
+        self.max = float("-inf")
+        self.min = float("inf")
+        self.sum = 0
+        self.count = 0
+        self.sketch.clear()
+        self.seen = 0
 
-    def flush(self, ts):
+    def values(self):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
+        min_ = self.min
+        max_ = self.max
+        values = [
+            ('.min', min_),
+            ('.max', max_),
+            ('.avg', self.sum / float(self.count)),
+            ('.count', self.count),
+        ]
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        avg = self.samples[int(round(length/2 - 1))]
+        quantiles = self.sketch.quantiles(self.percentiles)
+        for suffix, val in zip(self.percentile_suffixes, quantiles):
+            # The sketch is approximate, but the extremes are exact.
+            values.append((suffix, min(max(val, min_), max_)))
+        return values
 
 
-        metrics = [
-            {'host':self.hostname, 'tags': self.tags, 'metric' : '%s.min' % self.name, 'points' : [(ts, min_)]},
-            {'host':self.hostname, 'tags': self.tags, 'metric' : '%s.max' % self.name, 'points' : [(ts, max_)]},
-            {'host':self.hostname, 'tags': self.tags, 'metric' : '%s.avg' % self.name, 'points' : [(ts, avg)]},
-            {'host':self.hostname, 'tags': self.tags, 'metric' : '%s.count' % self.name, 'points' : [(ts, self.count)]},
-        ]
+class HyperLogLog(object):
+    """
+    A bounded-memory distinct count estimator.
+
+    Each value is hashed to 64 bits: the first PRECISION bits pick one of
+    2 ** PRECISION registers, which keeps the highest rank (position of the
+    first set bit) of the remaining bits seen. The estimate has a standard
+    error of 1.04 / sqrt(2 ** PRECISION), about 1.6%, and falls back to
+    linear counting for small cardinalities. Estimators are merged by
+    taking the maximum of each register.
+    """
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
-            name = '%s.%spercentile' % (self.name, int(p * 100))
-            metrics.append({'host': self.hostname, 'tags':self.tags, 'metric': name, 'points': [(ts, val)]})
-        return metrics
+    PRECISION = 12
+    REGISTERS = 1 << PRECISION
+    ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+    RANK_BITS = 64 - PRECISION
+    RANK_MASK = (1 << RANK_BITS) - 1
+
+    __slots__ = ('registers',)
+
+    def __init__(self):
+        self.registers = bytearray(self.REGISTERS)
+
+    def add(self, value, unpack=struct.unpack):
+        """ Add a (string) value to the estimator. """
+        x = unpack('<Q', md5(value).digest()[:8])[0]
+        index = x >> self.RANK_BITS
+        # The bit length of the rest, without int.bit_length (Python 2.7+).
+        rest = x & self.RANK_MASK
+        bits = rest and len(bin(rest)) - 2
+        rank = self.RANK_BITS - bits + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """ Add the values of another estimator to this one. """
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def cardinality(self):
+        """ Return the estimated number of distinct values added. """
+        m = self.REGISTERS
+        total = 0.0
+        zeros = 0
+        for rank in self.registers:
+            total += 2.0 ** -rank
+            if not rank:
+                zeros += 1
+        estimate = self.ALPHA * m * m / total
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class Set(Metric):
+    """
+    A metric that counts the distinct values seen. Values are kept as is, so
+    the count is exact, up to EXACT_SIZE of them; past that they are counted
+    by a HyperLogLog estimator, whose memory is fixed.
+    """
+
+    EXACT_SIZE = 256
+
+    __slots__ = ('values_seen', 'estimator')
+
+    value_type = str
+
+    def __init__(self):
+        self.values_seen = set()
+        self.estimator = None
+
+    def sample(self, value, sample_rate):
+        # Distinct counts can't be scaled up, the sample rate is ignored.
+        if self.estimator is not None:
+            self.estimator.add(value)
+        else:
+            self.values_seen.add(value)
+            if len(self.values_seen) > self.EXACT_SIZE:
+                self._switch_to_estimator()
+
+    def _switch_to_estimator(self):
+        self.estimator = HyperLogLog()
+        for value in self.values_seen:
+            self.estimator.add(value)
+        self.values_seen = None
+
+    def merge(self, other):
+        if other.estimator is not None:
+            if self.estimator is None:
+                self._switch_to_estimator()
+            self.estimator.merge(other.estimator)
+        else:
+            for value in other.values_seen:
+                self.sample(value, 1)
+
+    def reset(self):
+        self.values_seen = set()
+        self.estimator = None
+
+    def values(self):
+        if self.estimator is not None:
+            return [('', self.estimator.cardinality())]
+        return [('', len(self.values_seen))]
+
+
+class LRUCache(object):
+    """
+    A cache holding at most `size` entries, evicting the least recently used
+    one when it's full. Entries are kept in a circular doubly linked list of
+    [previous, next, key, value] links, ordered by last use.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ Return the value cached for the key, or None. """
+        link = self.entries.get(key)
+        if link is None:
+            return None
+
+        # Move the link to the most recently used end of the list.
+        previous, next_, _, value = link
+        previous[1] = next_
+        next_[0] = previous
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    def set(self, key, value):
+        """ Cache a value for a key that isn't in the cache. """
+        root = self.root
+        if len(self.entries) >= self.size:
+            # Evict the least recently used entry.
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.entries[oldest[2]]
+
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self.entries[key] = link
+
+
+class SpaceSaving(object):
+    """
+    Keeps track of the (approximately) `k` most frequent items of a stream
+    in O(k) memory, with the Space-Saving algorithm: an item that isn't
+    tracked replaces the least frequent one, inheriting its count. Counts
+    are over-estimated by at most the count they inherited.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        # Item -> [count, over-estimation].
+        self.counters = {}
+
+    def add(self, item):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+        elif len(self.counters) < self.k:
+            self.counters[item] = [1, 0]
+        else:
+            least = min(self.counters, key=lambda i: self.counters[i][0])
+            count = self.counters.pop(least)[0]
+            self.counters[item] = [count + 1, count]
+
+    def top(self):
+        """ Return the (item, count) pairs tracked, most frequent first. """
+        return sorted([(item, counter[0]) for item, counter in self.counters.items()],
+                      key=lambda c: c[1], reverse=True)
+
+
+class PrefixTrie(object):
+    """
+    A set of prefixes, stored as a trie of characters, so that a name is
+    matched against all of them in a single pass over its characters.
+    """
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def __len__(self):
+        return len(self.root)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None marks the end of a prefix.
+        node[None] = True
+
+    def matches(self, name):
+        """ Return whether the name starts with one of the prefixes. """
+        node = self.root
+        if None in node:
+            return True
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class MetricFilter(object):
+    """
+    Decides, before a metric is aggregated, whether it's kept and with
+    which tags:
+        - names must start with one of the `allow` prefixes (if any), and
+          not with one of the `deny` prefixes,
+        - tags named in `strip_tags` ("name:value" or "name") are removed,
+        - each tag name of a metric can take at most `max_tag_values`
+          values (0 for no limit), points with new values past that are
+          dropped.
+
+    Decisions never change for a given name and tags (tag values are
+    admitted forever), so they can be cached along with the parsing.
+    """
+
+    def __init__(self, allow=None, deny=None, strip_tags=None,
+                 max_tag_values=0):
+        self.allow = PrefixTrie(allow or [])
+        self.deny = PrefixTrie(deny or [])
+        self.strip_tags = frozenset(strip_tags or [])
+        self.max_tag_values = int(max_tag_values)
+        # Metric name -> tag name -> values admitted.
+        self.tag_values = {}
+
+    def filter(self, name, tags):
+        """
+        Return the (possibly stripped) tags of a metric to keep, or the
+        reason it's dropped: 'allow', 'deny' or 'cardinality'.
+        """
+        if self.allow and not self.allow.matches(name):
+            return None, 'allow'
+        if self.deny and self.deny.matches(name):
+            return None, 'deny'
+        if tags is None:
+            return tags, None
+
+        if self.strip_tags:
+            tags = tuple(t for t in tags
+                         if t.split(':', 1)[0] not in self.strip_tags) or None
+            if tags is None:
+                return tags, None
+
+        max_values = self.max_tag_values
+        if max_values:
+            metric_tag_values = self.tag_values.setdefault(name, {})
+            new_values = []
+            for tag in tags:
+                tag_name = tag.split(':', 1)[0]
+                values = metric_tag_values.setdefault(tag_name, set())
+                if tag not in values:
+                    if len(values) >= max_values:
+                        return None, 'cardinality'
+                    new_values.append((values, tag))
+            # Only admit the values of points that are kept.
+            for values, tag in new_values:
+                values.add(tag)
+        return tags, None
 
 
 class MetricsAggregator(object):
     """
     A metric aggregator class.
+
+    It's shared by the thread receiving packets and the one flushing them,
+    without any lock. Metrics are written in generations: one dict of
+    (name, tags) contexts per interval. The receiving thread only ever writes
+    to the generation of the current interval, which it keeps at hand, and
+    the flushing thread atomically pops the generations of completed
+    intervals from `generations`. Counters written by the receiving thread
+    are never reset, the flushing thread reports their growth since the last
+    flush.
+
+    Metric objects outlive their interval: once flushed (and after another
+    flush, when the receiving thread is sure to be done with them) they are
+    reset in place and handed back to the receiving thread, which reuses
+    them for the same contexts. Contexts idle for a whole interval expire.
     """
 
-    def __init__(self, hostname, interval):
-        self.metrics = {}
+    # The tags of the context metrics past their context limit fold into.
+    OVERFLOW_TAGS = ('overflow:true',)
+    # Number of tag sets to report for each metric past its context limit.
+    OVERFLOW_TOP_K = 10
+
+    def __init__(self, hostname, interval, parse_cache_size=10000,
+                 adaptive_sampling_threshold=0, metric_filter=None,
+                 max_contexts_per_metric=0):
+        # Generations by interval, each a dict of (name, tags) -> metric.
+        self.generations = {}
+        # The (interval, contexts) generation the receiving thread writes to.
+        self._generation = (None, None)
+        # Exports of other aggregators, waiting for the next flush.
+        self._merged = deque()
+        # The intervals of the last flush, to be recycled by the next one.
+        self._flushed = []
+        # Reset metrics by context, for the receiving thread to reuse.
+        self._recycled = {}
         self.total_count = 0
         self.count = 0
         self.metric_type_to_class = {
             'g': Gauge,
             'c': Counter,
             'h': Histogram,
-            'ms' : Histogram
+            'ms' : Histogram,
+            's': Set
         }
         self.hostname = hostname
         self.interval = interval
-
-    def submit(self, packet):
-        self.count += 1
-        # We can have colons in tags, so split once.
-        name_and_metadata = packet.split(':', 1)
-
-        if len(name_and_metadata) != 2:
-            raise Exception('Unparseable packet: %s' % packet)
-
-        name = name_and_metadata[0]
-        metadata = name_and_metadata[1].split('|')
-
-        if len(metadata) < 2:
-            raise Exception('Unparseable packet: %s' % packet)
+        self.diagnostic_sources = []
+        # Number of points per context and interval past which counters and
+        # histograms are sampled (0 to never sample).
+        self.adaptive_sampling_threshold = adaptive_sampling_threshold
+        # Drops or rewrites metrics before they're aggregated, if any.
+        self.metric_filter = metric_filter
+        # Number of contexts a metric name can have in an interval (0 for no
+        # limit). Past that, its points fold into an overflow context.
+        self.max_contexts_per_metric = max_contexts_per_metric
+        # Contexts by metric name in the current generation.
+        self._context_counts = {}
+        # Metric name -> SpaceSaving of the tags of its folded points.
+        self._overflows = {}
+        self.add_diagnostic_source(self.overflow_stats)
+
+        # No cache if its size is 0 (or less).
+        self.parse_cache = None
+        # The counters are only written by the thread submitting metrics, the
+        # flushing thread reports them by difference with the last values it
+        # reported.
+        self.parse_cache_hits = 0
+        self.parse_cache_misses = 0
+        self._reported_parse_cache_hits = 0
+        self._reported_parse_cache_misses = 0
+        if parse_cache_size > 0:
+            self.parse_cache = LRUCache(parse_cache_size)
+            self.add_diagnostic_source(self.parse_cache_stats)
+
+        # Lines that couldn't be parsed, by reason, and the contexts created.
+        # Also reported by difference with the last values reported.
+        self.parse_errors = {}
+        self._reported_parse_errors = {}
+        self.contexts_created = 0
+        self._reported_contexts_created = 0
+        # Points dropped by the filter, by reason.
+        self.filter_drops = {}
+        self._reported_filter_drops = {}
+        self.add_diagnostic_source(self.submit_stats)
+
+    def add_diagnostic_source(self, source):
+        """
+        Register a callable that returns a list of (metric name, value) pairs
+        to report alongside the aggregator's own diagnostic stats.
+        """
+        self.diagnostic_sources.append(source)
+
+    def submit_packets(self, packets):
+        """ Submit a batch of packets, logging the ones we can't parse. """
+        # The whole batch goes to the same interval.
+        self.update_interval()
+        submit = self.submit_packet
+        for packet in packets:
+            try:
+                submit(packet)
+            except:
+                logger.exception('Error submitting packet')
+
+    def update_interval(self, timestamp=None):
+        """
+        Make the receiving thread write to the generation of the interval of
+        the given time (now by default). It's done once per packet or batch
+        of packets, not for every metric.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        # Bucket metrics by an interval of a few seconds to avoid race
+        # conditions betwen the threads.
+        interval = timestamp - timestamp % self.interval
+        if interval != self._generation[0]:
+            self._start_generation(interval)
+
+    def parse_error(self, reason, message):
+        """ Count a parse error for the given reason, and return it. """
+        self.parse_errors[reason] = self.parse_errors.get(reason, 0) + 1
+        return Exception(message)
+
+    def parse_metadata(self, name, metadata):
+        """
+        Parse everything following the value of a metric line, and return
+        the (name, metric class, sample rate, tags) of the metric. If the
+        filter drops it, return (None, reason, None, None) instead.
+        """
+        metadata = metadata.split('|')
+        try:
+            metric_class = self.metric_type_to_class[metadata[0]]
+        except KeyError:
+            raise self.parse_error('type', 'Unknown metric type: %s' % metadata[0])
 
         # Parse the optional values - sample rate & tags.
         sample_rate = 1
         tags = None
-        for m in metadata[2:]:
+        for m in metadata[1:]:
+            if not m:
+                raise self.parse_error('format', 'Empty metric field')
             # Parse the sample rate
             if m[0] == '@':
-                sample_rate = float(m[1:])
-                assert 0 <= sample_rate <= 1
+                try:
+                    sample_rate = float(m[1:])
+                except ValueError:
+                    sample_rate = None
+                if not sample_rate or not 0 < sample_rate <= 1:
+                    raise self.parse_error('sample_rate',
+                        'Invalid sample rate: %s' % m[1:])
+                if sample_rate == 1:
+                    # Keep the values of unsampled metrics integral.
+                    sample_rate = 1
             elif m[0] == '#':
                 tags = tuple(sorted(m[1:].split(',')))
 
-        # Bucket metrics by an interval of a few seconds to avoid race
-        # conditions betwen the threads.
-        timestamp = time.time()
-        interval = timestamp - timestamp % self.interval
+        if self.metric_filter is not None:
+            tags, reason = self.metric_filter.filter(name, tags)
+            if reason is not None:
+                return None, reason, None, None
 
-        context = (interval, name, tags)
-        if context not in self.metrics:
-            metric_class = self.metric_type_to_class[metadata[1]]
-            self.metrics[context] = metric_class(name, tags, self.hostname)
-        self.metrics[context].sample(float(metadata[0]), sample_rate)
+        return name, metric_class, sample_rate, tags
 
+    def parse_cache_stats(self):
+        """ Report the parse cache hits and misses since the last call. """
+        hits, misses = self.parse_cache_hits, self.parse_cache_misses
+        stats = [
+            ('dd.dogstatsd.parse_cache.hits', hits - self._reported_parse_cache_hits),
+            ('dd.dogstatsd.parse_cache.misses', misses - self._reported_parse_cache_misses),
+        ]
+        self._reported_parse_cache_hits = hits
+        self._reported_parse_cache_misses = misses
+        return stats
+
+    def submit_stats(self):
+        """
+        Report the parse errors by reason, the contexts created and the
+        points dropped by the filter by reason since the last call.
+        """
+        created = self.contexts_created
+        stats = [('dd.dogstatsd.contexts.created',
+                  created - self._reported_contexts_created)]
+        self._reported_contexts_created = created
+
+        for prefix, counts, reported in (
+                ('dd.dogstatsd.parse_error.', self.parse_errors,
+                 self._reported_parse_errors),
+                ('dd.dogstatsd.filter.dropped.', self.filter_drops,
+                 self._reported_filter_drops)):
+            for reason, count in counts.items():
+                stats.append((prefix + reason, count - reported.get(reason, 0)))
+                reported[reason] = count
+        return stats
+
+    def submit(self, packet):
+        """
+        Submit a packet holding one or more newline-separated metrics. Every
+        line is parsed independently: if some of them are invalid, the valid
+        ones are still aggregated and the error lists each bad line.
+        """
+        self.update_interval()
+        self.submit_packet(packet)
+
+    def submit_packet(self, packet):
+        """ Same as `submit`, in the interval set by `update_interval`. """
+        self.count += 1
+        errors = []
+        submit_metric = self.submit_metric
+        for line in packet.split('\n'):
+            if not line:
+                continue
+            try:
+                submit_metric(line)
+            except Exception, e:
+                errors.append('%r (%s)' % (line, e))
+
+        if errors:
+            raise Exception('Unparseable packet, %s bad line(s): %s' % (
+                len(errors), '; '.join(errors)))
+
+    def submit_metric(self, line):
+        """
+        Parse and aggregate a single metric line, in the interval set by
+        `update_interval`.
+        """
+        # The value is the only part of the line that changes from one point
+        # of a context to the next, so the parsing of the rest of it
+        # ("name|type|@sample_rate|#tags") is cached.
+        name_end = line.find(':')
+        value_end = line.find('|', name_end + 1)
+        if name_end == -1 or value_end == -1:
+            raise self.parse_error('format', 'Unparseable metric: %s' % line)
+
+        parse_cache = self.parse_cache
+        if parse_cache is None:
+            parsed = self.parse_metadata(line[:name_end], line[value_end + 1:])
+        else:
+            key = line[:name_end] + line[value_end:]
+            parsed = parse_cache.get(key)
+            if parsed is None:
+                self.parse_cache_misses += 1
+                parsed = self.parse_metadata(line[:name_end], line[value_end + 1:])
+                parse_cache.set(key, parsed)
+            else:
+                self.parse_cache_hits += 1
+        name, metric_class, sample_rate, tags = parsed
+        if name is None:
+            # Filtered out, metric_class is the reason.
+            self.filter_drops[metric_class] = self.filter_drops.get(metric_class, 0) + 1
+            return
+
+        # Parse the value before creating a context for it.
+        try:
+            value = metric_class.value_type(line[name_end + 1:value_end])
+        except ValueError:
+            raise self.parse_error('value',
+                'Invalid value: %s' % line[name_end + 1:value_end])
+
+        contexts = self._generation[1]
+        context = (name, tags)
+        metric = contexts.get(context)
+        if metric is None:
+            limit = self.max_contexts_per_metric
+            if limit:
+                context_count = self._context_counts.get(name, 0)
+                if context_count >= limit:
+                    metric = self._overflow_metric(contexts, name, tags, metric_class)
+                    if metric is None:
+                        return
+                else:
+                    self._context_counts[name] = context_count + 1
+            if metric is None:
+                metric = self._new_metric(contexts, context, metric_class)
+
+        threshold = self.adaptive_sampling_threshold
+        if threshold and metric_class.adaptive:
+            metric.seen += 1
+            seen = metric.seen
+            if seen > threshold:
+                # Keep the n-th point of the interval with a probability of
+                # threshold / n, and weight it up accordingly, so totals stay
+                # unbiased while the work per context grows logarithmically.
+                rate = float(threshold) / seen
+                if random() >= rate:
+                    return
+                sample_rate *= rate
+                self._report_sample_rate(contexts, name, rate)
+        metric.sample(value, sample_rate)
+
+    def _new_metric(self, contexts, context, metric_class):
+        """ Add a metric for the context to the given generation. """
+        # Reuse the metric of the context from a past interval, if any.
+        metric = self._recycled.pop(context, None)
+        if metric is None or metric.__class__ is not metric_class:
+            metric = metric_class()
+            self.contexts_created += 1
+        contexts[context] = metric
+        return metric
+
+    def _overflow_metric(self, contexts, name, tags, metric_class):
+        """
+        Return the metric that a point of a metric past its context limit
+        folds into, or None if the point must be dropped.
+        """
+        overflow = self._overflows.get(name)
+        if overflow is None:
+            overflow = self._overflows[name] = SpaceSaving(self.OVERFLOW_TOP_K)
+        overflow.add(tags)
+
+        # Count the points folded, in the generation so that it's merged
+        # like any other metric.
+        counter_context = ('dd.dogstatsd.context_overflow', ('metric:%s' % name,))
+        counter = contexts.get(counter_context)
+        if counter is None:
+            counter = contexts[counter_context] = Counter()
+        counter.value += 1
+
+        context = (name, self.OVERFLOW_TAGS)
+        metric = contexts.get(context)
+        if metric is None:
+            metric = self._new_metric(contexts, context, metric_class)
+        elif metric.__class__ is not metric_class:
+            # The name is used with several metric types, we can't fold it.
+            return None
+        return metric
+
+    def overflow_stats(self):
+        """
+        Warn about the metrics that went past their context limit since the
+        last call, with the tags they were sent with most, and report how
+        many they are.
+        """
+        overflows, self._overflows = self._overflows, {}
+        for name, overflow in sorted(overflows.items()):
+            top = ', '.join('%s (%s)' % (','.join(tags or ()) or '<no tags>', count)
+                            for tags, count in overflow.top())
+            logger.warn("Metric %s went past %s contexts, points with new tags "
+                "were folded into %s. Most frequent tags: %s" % (name,
+                self.max_contexts_per_metric, ','.join(self.OVERFLOW_TAGS), top))
+        if not self.max_contexts_per_metric:
+            return []
+        return [('dd.dogstatsd.context_overflow.metrics', len(overflows))]
+
+    @staticmethod
+    def _report_sample_rate(contexts, name, rate):
+        """ Record the latest adaptive sample rate applied to a metric. """
+        context = ('dd.dogstatsd.adaptive_sample_rate', ('metric:%s' % name,))
+        gauge = contexts.get(context)
+        if gauge is None:
+            gauge = contexts[context] = Gauge()
+        gauge.value = rate
+
+    def _start_generation(self, interval):
+        """
+        Start writing to the generation of a new interval. Only called by the
+        receiving thread.
+        """
+        contexts = self.generations.get(interval)
+        if contexts is None:
+            contexts = self.generations[interval] = {}
+        self._generation = (interval, contexts)
+        self._context_counts = {}
+        return contexts
+
+    def pop_finished(self, timestamp=None):
+        """
+        Take everything that's ready to be flushed at the given time, and
+        return the (packet count, [(interval, contexts)], diagnostic stats)
+        gathered since the last call. Generations of the same interval (e.g.
+        merged from several workers) are combined.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        current_interval = timestamp - timestamp % self.interval
+
+        # The packet count only grows, report the difference with what was
+        # last reported.
+        total_count = self.count
+        count = total_count - self.total_count
+        self.total_count = total_count
+
+        # Claim the completed generations. dict.pop is atomic so a generation
+        # is only ever taken once, and only the handful of interval keys are
+        # scanned, whatever the number of live contexts.
+        finished = {}
+        for interval in self.generations.keys():
+            if interval < current_interval:
+                contexts = self.generations.pop(interval, None)
+                if contexts is not None:
+                    self._combine(finished, interval, contexts)
+
+        diagnostic_stats = self.get_diagnostic_stats()
+
+        # Then everything merged from other aggregators, summing their stats
+        # with ours.
+        merged = self._merged
+        if merged:
+            summed_stats = dict(diagnostic_stats)
+            while merged:
+                merged_count, intervals, stats = merged.popleft()
+                count += merged_count
+                for interval, contexts in intervals:
+                    self._combine(finished, interval, contexts)
+                for name, value in stats:
+                    summed_stats[name] = summed_stats.get(name, 0) + value
+            diagnostic_stats = summed_stats.items()
+
+        return count, sorted(finished.items()), diagnostic_stats
+
+    @staticmethod
+    def _combine(finished, interval, contexts):
+        existing = finished.get(interval)
+        if existing is None:
+            finished[interval] = contexts
+            return
+        for context, metric in contexts.items():
+            if context in existing:
+                existing[context].merge(metric)
+            else:
+                existing[context] = metric
+
+    def get_diagnostic_stats(self):
+        """ Return the (metric name, value) pairs of the diagnostic sources. """
+        stats = []
+        for source in self.diagnostic_sources:
+            try:
+                stats.extend(source())
+            except:
+                logger.exception('Error collecting diagnostic stats')
+        return stats
+
+    def export(self):
+        """
+        Pop the completed intervals and the stats gathered since the last
+        call, in a form that can be given to another aggregator's `merge`.
+        """
+        return self.pop_finished()
+
+    def merge(self, exported):
+        """
+        Hand the output of another aggregator's `export` over to the next
+        flush, which will combine it with its own intervals.
+        """
+        self._merged.append(exported)
+
+    @staticmethod
+    def _flush_stats(count, intervals, diagnostic_stats):
+        """
+        Return the (metric name, value) pairs of the stats to flush along
+        with the given intervals.
+        """
+        contexts = 0
+        for _, interval_contexts in intervals:
+            contexts += len(interval_contexts)
+        return [
+            ('dd.dogstatsd.packet.count', count),
+            ('dd.dogstatsd.contexts', contexts),
+        ] + list(diagnostic_stats)
 
     def flush(self, include_diagnostic_stats=True):
         # Flush all completed intervals bucketed up to this time.
         timestamp = time.time()
-        interval = timestamp - timestamp % self.interval
-
-        # Find all intervals that are completed (don't use a generator here)
-        past_contexts = [c for c in self.metrics if c[0] < interval]
+        count, intervals, diagnostic_stats = self.pop_finished(timestamp)
 
-        # Flush all completed metrics and remove them.
+        # Flush all completed metrics. The receiving thread may still hold a
+        # reference to a generation for the duration of a packet, so iterate
+        # over a snapshot of its contexts.
         metrics = []
-        for context in past_contexts:
-            metrics += self.metrics[context].flush(timestamp)
-            del self.metrics[context]
+        hostname = self.hostname
+        for _, contexts in intervals:
+            for (name, tags), metric in contexts.items():
+                metrics += metric.flush(timestamp, name, tags, hostname)
 
         # Track how many points we see.
         if include_diagnostic_stats:
-            metrics.append({
-                'host':self.hostname,
-                'tags':None,
-                'metric': 'dd.dogstatsd.packet.count',
-                'points': [(timestamp, self.count)]
-            })
+            for name, value in self._flush_stats(count, intervals, diagnostic_stats):
+                metrics.append({
+                    'host': self.hostname,
+                    'tags': None,
+                    'metric': name,
+                    'points': [(timestamp, value)]
+                })
+
+        self._recycle(intervals)
 
         # Save some stats.
-        logger.info("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
+        logger.info("received %s payloads since last flush" % count)
         return metrics
 
+    def _recycle(self, intervals):
+        """
+        Reset the metrics of the previous flush and hand them over to the
+        receiving thread, then keep the intervals just flushed for the next
+        call. The receiving thread may still write to an interval for the
+        duration of a batch after it's flushed, waiting for the next flush
+        makes sure it's done.
+        """
+        flushed, self._flushed = self._flushed, intervals
+        recycled = {}
+        for _, contexts in flushed:
+            for context, metric in contexts.iteritems():
+                metric.reset()
+                recycled[context] = metric
+        # Contexts left over from the previous hand-over, idle for a whole
+        # interval, are dropped.
+        self._recycled = recycled
+
+    def flush_serialized(self, include_diagnostic_stats=True):
+        """
+        Same as `flush`, but return each point of the series as a JSON
+        string, built straight from the metrics without going through
+        intermediate dicts. The hostname and timestamp are encoded once per
+        flush, the name and tags once per context.
+        """
+        timestamp = time.time()
+        count, intervals, diagnostic_stats = self.pop_finished(timestamp)
+
+        template = '{"metric":"%%s%%s","points":[[%s,%%s]],"tags":%%s,"host":%s}' % (
+            encode_json_number(timestamp),
+            encode_json_string(self.hostname).replace('%', '%%'))
+        encode_string = encode_json_string
+        encode_number = encode_json_number
+        encode_tags = encode_json_tags
+
+        series = []
+        append = series.append
+        for _, contexts in intervals:
+            for (name, tags), metric in contexts.items():
+                values = metric.values()
+                if not values:
+                    continue
+                # Strip the quotes, the name is completed by the suffix.
+                name = encode_string(name)[1:-1]
+                tags = encode_tags(tags)
+                for suffix, value in values:
+                    append(template % (name, suffix, encode_number(value), tags))
+
+        if include_diagnostic_stats:
+            for name, value in self._flush_stats(count, intervals, diagnostic_stats):
+                append(template % (encode_string(name)[1:-1], '', encode_number(value), 'null'))
+
+        self._recycle(intervals)
+
+        logger.info("received %s payloads since last flush" % count)
+        return series
 
 
 class Reporter(threading.Thread):
@@ -216,7 +1176,10 @@ class Reporter(threading.Thread):
     server.
     """
 
-    def __init__(self, interval, metrics_aggregator, api_host, api_key=None):
+    def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
+            use_gzip=True, connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT, max_points_per_post=1000,
+            max_post_size=1024 * 1024, chunk_retries=2, spool=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.interval = int(interval)
@@ -236,6 +1199,28 @@ class Reporter(threading.Thread):
             if match.group(1) == 'http':
                 self.http_conn_cls = http_client.HTTPConnection
 
+        self.use_gzip = use_gzip
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_points_per_post = int(max_points_per_post)
+        self.max_post_size = int(max_post_size)
+        self.chunk_retries = int(chunk_retries)
+        # The connection kept alive between flushes.
+        self.conn = None
+        # Where chunks that couldn't be delivered wait to be replayed, if
+        # anywhere.
+        self.spool = spool
+
+        # Stats of the flushes since the last report, reported with the next
+        # flush.
+        self.flush_duration = None
+        self.serialization_duration = None
+        self.payload_bytes = 0
+        self.http_latency_total = 0.0
+        self.http_requests = 0
+        if metrics_aggregator is not None:
+            metrics_aggregator.add_diagnostic_source(self.diagnostic_stats)
+
     def end(self):
         self.finished.set()
 
@@ -248,25 +1233,185 @@ class Reporter(threading.Thread):
             self.flush()
 
     def flush(self):
+        start = time.time()
         try:
             self.flush_count += 1
-            metrics = self.metrics_aggregator.flush()
-            count = len(metrics)
+            series = self.metrics_aggregator.flush_serialized()
+            self.serialization_duration = time.time() - start
+            count = len(series)
             if not count:
                 logger.info("Flush #{0}: No metrics to flush.".format(self.flush_count))
-                return
-            logger.info("Flush #{0}: flushing {1} metrics".format(self.flush_count, count))
-            self.submit(metrics)
+                delivered = True
+            else:
+                logger.info("Flush #{0}: flushing {1} metrics".format(self.flush_count, count))
+                delivered = self.submit_serialized(series)
+            # Replay the spooled chunks once the intake takes the current
+            # flush again.
+            if delivered and self.spool is not None and len(self.spool):
+                self.replay_spool()
         except:
             logger.exception("Error flushing metrics")
+        finally:
+            self.flush_duration = time.time() - start
+
+    def diagnostic_stats(self):
+        """
+        Report the duration of the last flush and of its serialization, and
+        the payload bytes and mean HTTP latency of the posts since the last
+        call. Called during a flush, so it reports on the previous ones.
+        """
+        stats = []
+        if self.flush_duration is not None:
+            stats.append(('dd.dogstatsd.flush.duration', self.flush_duration))
+        if self.serialization_duration is not None:
+            stats.append(('dd.dogstatsd.serialization.duration',
+                          self.serialization_duration))
+        stats.append(('dd.dogstatsd.payload.bytes', self.payload_bytes))
+        if self.spool is not None:
+            stats.append(('dd.dogstatsd.spool.bytes', self.spool.size))
+        if self.http_requests:
+            stats.append(('dd.dogstatsd.http.latency',
+                          self.http_latency_total / self.http_requests))
+        self.payload_bytes = 0
+        self.http_latency_total = 0.0
+        self.http_requests = 0
+        return stats
+
+    def get_connection(self):
+        """ Return the kept-alive connection, opening it if needed. """
+        if self.conn is None:
+            conn = self.http_conn_cls(self.api_host, timeout=self.connect_timeout)
+            conn.connect()
+            # Once connected, wait for responses for up to read_timeout.
+            conn.sock.settimeout(self.read_timeout)
+            self.conn = conn
+        return self.conn
+
+    def close_connection(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except:
+                logger.exception("Error closing connection")
+            self.conn = None
 
     def submit(self, metrics):
+        """ Post metrics given as dicts, see `submit_serialized`. """
+        self.submit_serialized([json.dumps(m) for m in metrics])
+
+    def submit_serialized(self, series):
+        """
+        Post series points (each a JSON string) in chunks, in order. A chunk
+        that can't be posted (after retries) is dropped without affecting the
+        others, but if the intake can't be reached the remaining chunks
+        aren't posted either. Return whether every chunk was delivered.
+        """
+        chunk_count = 0
+        failed_count = 0
+        spooled_count = 0
+        undelivered = []
+        bodies = self.chunk(series)
+        for body in bodies:
+            chunk_count += 1
+            try:
+                accepted = self.submit_chunk(body)
+            except (socket.error, http_client.HTTPException):
+                logger.exception("Error posting metrics, not posting the "
+                                 "remaining chunks")
+                # They'd wait for the same timeouts.
+                remaining = list(bodies)
+                chunk_count += len(remaining)
+                undelivered.append(body)
+                undelivered.extend(remaining)
+                break
+            if accepted is None:
+                undelivered.append(body)
+            elif not accepted:
+                failed_count += 1
+
+        # Keep what couldn't be delivered (but not what was refused) to
+        # replay it later.
+        for body in undelivered:
+            failed_count += 1
+            if self.spool is not None and self.spool.append(body):
+                spooled_count += 1
+
+        if failed_count:
+            logger.error("Failed to submit %s out of %s chunks, %s spooled" % (
+                failed_count, chunk_count, spooled_count))
+        return not undelivered
+
+    def replay_spool(self):
+        """
+        Post the spooled chunks, oldest first, until one can't be delivered.
+        They aren't retried, they stay in the spool for the next flush.
+        """
+        def replay(body):
+            # Refused chunks are dropped from the spool too.
+            try:
+                return self.submit_chunk(body, retries=0) is not None
+            except (socket.error, http_client.HTTPException):
+                logger.exception("Error replaying spooled metrics")
+                return False
+        replayed = self.spool.replay(replay)
+        if replayed:
+            logger.info("Replayed %s spooled chunks" % replayed)
+
+    def chunk(self, series):
+        """
+        Yield the bodies of chunks of at most max_points_per_post points and
+        max_post_size bytes (unless a single point is bigger than that).
+        """
+        head = '{"series":['
+        tail = ']}'
+        max_points = self.max_points_per_post
+        max_size = self.max_post_size - len(head) - len(tail)
+
+        chunk = []
+        size = 0
+        for point in series:
+            # Count the separating comma too.
+            point_size = len(point) + 1
+            if chunk and (len(chunk) >= max_points or size + point_size > max_size):
+                yield head + ','.join(chunk) + tail
+                chunk = []
+                size = 0
+            chunk.append(point)
+            size += point_size
+
+        if chunk:
+            yield head + ','.join(chunk) + tail
+
+    def submit_chunk(self, body, retries=None):
+        """
+        Post a chunk, retrying on server errors. Return True if it was
+        accepted, False if it was refused, and None if it couldn't be
+        delivered. Connection errors are raised without retrying: the intake
+        can't be reached (`post` already reconnects once if a kept-alive
+        connection was closed).
+        """
+        if retries is None:
+            retries = self.chunk_retries
+        for attempt in xrange(1 + retries):
+            status = self.post(body)
+            if status < 400:
+                return True
+            elif status < 500:
+                # The payload was refused, no use sending it again.
+                return False
+            logger.warn("Error posting metrics (attempt %s): status %s" % (
+                attempt + 1, status))
+        return None
+
+    def post(self, body):
+        """ Post a series body, and return the response status. """
 
         # HACK - Copy and pasted from dogapi, because it's a bit of a pain to distribute python
         # dependencies with the agent.
-        conn = self.http_conn_cls(self.api_host)
-        body = json.dumps({"series" : metrics})
         headers = {'Content-Type':'application/json'}
+        if self.use_gzip:
+            body = gzip_compress(body)
+            headers['Content-Encoding'] = 'gzip'
         method = 'POST'
 
         params = {}
@@ -274,49 +1419,320 @@ class Reporter(threading.Thread):
             params['api_key'] = self.api_key
         url = '/api/v1/series?%s' % urlencode(params)
 
-        start_time = time.time()
-        conn.request(method, url, body, headers)
-
-        #FIXME: add timeout handling code here
-
-        response = conn.getresponse()
-        duration = round((time.time() - start_time) * 1000.0, 4)
-        logger.info("%s %s %s%s (%sms)" % (
-                        response.status, method, self.api_host, url, duration))
+        # The server may have closed the kept-alive connection since the last
+        # flush, in which case retry once on a new connection. Only when it
+        # evidently didn't process the request: past that (a read timeout
+        # for instance), the post may have gone through and isn't repeated.
+        for attempt in (1, 2):
+            reused = self.conn is not None
+            start_time = time.time()
+            try:
+                conn = self.get_connection()
+                try:
+                    conn.request(method, url, body, headers)
+                except socket.error, e:
+                    if reused and attempt == 1 and e.args and \
+                            e.args[0] in (errno.ECONNRESET, errno.EPIPE):
+                        self.close_connection()
+                        logger.info("Kept-alive connection closed, reconnecting")
+                        continue
+                    raise
+                try:
+                    response = conn.getresponse()
+                except http_client.BadStatusLine:
+                    # Closed without an answer.
+                    if reused and attempt == 1:
+                        self.close_connection()
+                        logger.info("Kept-alive connection closed, reconnecting")
+                        continue
+                    raise
+                # Read the whole response to be able to reuse the connection.
+                response.read()
+            except (socket.error, http_client.HTTPException):
+                self.close_connection()
+                raise
+
+            if response.will_close:
+                self.close_connection()
+            latency = time.time() - start_time
+            self.payload_bytes += len(body)
+            self.http_latency_total += latency
+            self.http_requests += 1
+            duration = round(latency * 1000.0, 4)
+            logger.info("%s %s %s%s (%sms)" % (
+                            response.status, method, self.api_host, url, duration))
+            return response.status
 
 class Server(object):
     """
-    A statsd udp server.
+    A statsd udp server, optionally also listening on a unix datagram socket
+    so that local clients skip the network stack and block (instead of
+    losing packets) when we lag behind.
     """
 
-    def __init__(self, metrics_aggregator, host, port):
+    def __init__(self, metrics_aggregator, host, port, so_rcvbuf=None,
+            batch_size=1000, buffer_size=8192, reuse_port=False,
+            socket_path=None, socket_rcvbuf=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
 
         self.metrics_aggregator = metrics_aggregator
 
-        self.buffer_size = 1024
+        # Clients can pack several metrics in a datagram, make sure we don't
+        # truncate them.
+        self.buffer_size = min(int(buffer_size), MAX_BUFFER_SIZE)
+        self.batch_size = int(batch_size)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if so_rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                int(so_rcvbuf))
+        if reuse_port:
+            # Let several processes bind the port, the kernel then spreads
+            # the datagrams between them.
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind(self.address)
+        # Reads are done by draining the socket after select tells us it's
+        # readable, so it must never block.
+        self.socket.setblocking(0)
+
+        self.socket_path = socket_path
+        self.unix_socket = None
+        if socket_path:
+            self.unix_socket = self.bind_unix_socket(socket_path, socket_rcvbuf)
+
+        self._inode = os.fstat(self.socket.fileno()).st_ino
+        self._last_drops = None
+        # Seconds spent waiting for datagrams, only written by the receiving
+        # thread.
+        self.idle_time = 0.0
+        self._reported_idle_time = 0.0
+        self.metrics_aggregator.add_diagnostic_source(self.diagnostic_stats)
+
+    @staticmethod
+    def bind_unix_socket(path, rcvbuf=None):
+        """ Return a non-blocking unix datagram socket bound to path. """
+        # Remove the socket left by a previous run, but nothing else.
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+        sock.bind(path)
+        # Any local user may send metrics, as they can over udp.
+        os.chmod(path, 0666)
+        sock.setblocking(0)
+        return sock
+
+    def get_kernel_drops(self):
+        """
+        Return the number of datagrams the kernel dropped on our socket
+        because its receive buffer was full, or None if it's unknown on this
+        platform.
+        """
+        inode = str(self._inode)
+        for path in PROC_NET_UDP:
+            try:
+                f = open(path)
+            except IOError:
+                continue
+            try:
+                # Skip the header line. The inode is the 10th column and the
+                # drop count the last one.
+                f.readline()
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[-1])
+            finally:
+                f.close()
+        return None
+
+    def diagnostic_stats(self):
+        """
+        Report the time spent waiting for datagrams and the datagrams dropped
+        by the kernel since the last call.
+        """
+        idle_time = self.idle_time
+        stats = [('dd.dogstatsd.receive.idle_time',
+                  idle_time - self._reported_idle_time)]
+        self._reported_idle_time = idle_time
+
+        drops = self.get_kernel_drops()
+        if drops is None:
+            return stats
+        last_drops, self._last_drops = self._last_drops, drops
+        if last_drops is None:
+            last_drops = 0
+        stats.append(('dd.dogstatsd.udp.drops', drops - last_drops))
+        return stats
 
     def start(self):
         """ Run the server. """
         logger.info('Starting dogstatsd server on %s' % str(self.address))
+        if self.unix_socket is not None:
+            logger.info('Listening on unix socket %s' % self.socket_path)
 
         # Inline variables to speed up look-ups.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit
-        socket_recv = self.socket.recv
+        batch_size = self.batch_size
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        select_select = select.select
+        readers = [self.socket]
+        if self.unix_socket is not None:
+            readers.append(self.unix_socket)
+        would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
+        now = time.time
 
         while True:
             try:
-                aggregator_submit(socket_recv(buffer_size))
+                idle_start = now()
+                readable, _, _ = select_select(readers, [], [])
+                self.idle_time += now() - idle_start
+
+                # Drain everything the kernel has buffered (up to a batch) so
+                # we pay the wake-up cost once per batch, not per datagram.
+                packets = []
+                for sock in readable:
+                    socket_recv = sock.recv
+                    try:
+                        while len(packets) < batch_size:
+                            packets.append(socket_recv(buffer_size))
+                    except socket.error, e:
+                        if e.args[0] not in would_block:
+                            raise
+
+                aggregator_submit(packets)
             except (KeyboardInterrupt, SystemExit):
                 break
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    logger.exception('Error receiving datagram')
             except:
                 logger.exception('Error receiving datagram')
 
+class Exporter(threading.Thread):
+    """
+    Periodically sends the completed intervals of a worker's aggregator to
+    the reporting process.
+    """
+
+    def __init__(self, interval, metrics_aggregator, queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.finished = threading.Event()
+        self.metrics_aggregator = metrics_aggregator
+        self.queue = queue
+
+    def end(self):
+        self.finished.set()
+
+    def run(self):
+        while not self.finished.is_set():
+            self.finished.wait(self.interval)
+            try:
+                self.queue.put(self.metrics_aggregator.export())
+            except:
+                logger.exception("Error exporting metrics")
+
+
+class Worker(Process):
+    """
+    A process running its own server and aggregator on a port shared with
+    the other workers.
+    """
+
+    def __init__(self, queue, hostname, rollup_interval, aggregator_options,
+            host, port, **server_options):
+        Process.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.hostname = hostname
+        self.rollup_interval = rollup_interval
+        self.aggregator_options = aggregator_options
+        self.host = host
+        self.port = port
+        self.server_options = server_options
+
+    def run(self):
+        aggregator = MetricsAggregator(self.hostname, self.rollup_interval,
+            **self.aggregator_options)
+        server = Server(aggregator, self.host, self.port, reuse_port=True,
+            **self.server_options)
+        exporter = Exporter(WORKER_EXPORT_INTERVAL, aggregator, self.queue)
+        exporter.start()
+        server.start()
+
+
+class ShardedServer(object):
+    """
+    A statsd udp server spreading the load over several worker processes
+    bound to the same port with SO_REUSEPORT. Each worker aggregates its own
+    share of the traffic, and the partial aggregates are merged in the given
+    aggregator before being reported. A unix socket can't be shared that way,
+    so only the first worker listens on it.
+    """
+
+    def __init__(self, metrics_aggregator, host, port, workers,
+            aggregator_options=None, **server_options):
+        self.metrics_aggregator = metrics_aggregator
+        self.address = (host, int(port))
+        self.queue = Queue()
+        self.workers = []
+        for i in xrange(int(workers)):
+            if i > 0:
+                server_options = dict(server_options, socket_path=None)
+            self.workers.append(Worker(self.queue, metrics_aggregator.hostname,
+                metrics_aggregator.interval, aggregator_options or {}, host,
+                port, **server_options))
+
+        # Fork the workers right away, before the process starts any thread.
+        logger.info('Starting %s dogstatsd workers on %s' % (
+            len(self.workers), str(self.address)))
+        for worker in self.workers:
+            worker.start()
+
+    def start(self):
+        """ Merge the aggregates of the workers. """
+        aggregator_merge = self.metrics_aggregator.merge
+        queue_get = self.queue.get
+
+        while True:
+            try:
+                aggregator_merge(queue_get(True, 1))
+            except Empty:
+                pass
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except:
+                logger.exception('Error merging worker metrics')
+
+        for worker in self.workers:
+            worker.terminate()
+
+
+def get_metric_filter(c):
+    """ Return the metric filter described by the config, if any. """
+    def get_list(option):
+        value = c[option]
+        if not value:
+            return []
+        return [v.strip() for v in value.split(',') if v.strip()]
+
+    allow = get_list('dogstatsd_allow_prefixes')
+    deny = get_list('dogstatsd_deny_prefixes')
+    strip_tags = get_list('dogstatsd_strip_tags')
+    max_tag_values = int(c['dogstatsd_max_tag_values'])
+    if not (allow or deny or strip_tags or max_tag_values):
+        return None
+    return MetricFilter(allow, deny, strip_tags, max_tag_values)
+
+
 def main(config_path=None):
 
     c = get_config(parse_args=False, cfg_path=config_path, init_logging=True)
@@ -325,6 +1741,23 @@ def main(config_path=None):
     target   = c['dogstatsd_target']
     interval = c['dogstatsd_interval']
     api_key  = c['api_key']
+    use_gzip = c['dogstatsd_use_gzip']
+    max_points_per_post = int(c['dogstatsd_max_points_per_post'])
+    max_post_size = int(c['dogstatsd_max_post_size'])
+    so_rcvbuf = c['dogstatsd_so_rcvbuf']
+    batch_size = int(c['dogstatsd_batch_size'])
+    buffer_size = int(c['dogstatsd_buffer_size'])
+    workers = int(c['dogstatsd_workers'])
+    socket_path = c['dogstatsd_socket']
+    socket_rcvbuf = c['dogstatsd_socket_rcvbuf']
+    spool_dir = c['dogstatsd_spool_dir']
+    spool_max_size = int(c['dogstatsd_spool_max_size'])
+    aggregator_options = dict(
+        parse_cache_size=int(c['dogstatsd_parse_cache_size']),
+        adaptive_sampling_threshold=int(c['dogstatsd_adaptive_sampling_threshold']),
+        metric_filter=get_metric_filter(c),
+        max_contexts_per_metric=int(c['dogstatsd_max_contexts_per_metric']),
+    )
     host = 'localhost'
 
     hostname = gethostname(c)
@@ -332,15 +1765,33 @@ def main(config_path=None):
 
     # Create the aggregator (which is the point of communication between the
     # server and reporting threads.
-    aggregator = MetricsAggregator(hostname, rollup_interval)
+    aggregator = MetricsAggregator(hostname, rollup_interval,
+        **aggregator_options)
+
+    # Create the server (forking the workers, if any, before we start
+    # threads).
+    server_host = ''
+    server_options = dict(so_rcvbuf=so_rcvbuf, batch_size=batch_size,
+        buffer_size=buffer_size, socket_path=socket_path,
+        socket_rcvbuf=socket_rcvbuf)
+    if workers > 1:
+        server = ShardedServer(aggregator, server_host, port, workers,
+            aggregator_options=aggregator_options, **server_options)
+    else:
+        server = Server(aggregator, server_host, port, **server_options)
+
+    # Keep what can't be delivered on disk, if configured.
+    spool = None
+    if spool_dir:
+        spool = Spool(spool_dir, max_size=spool_max_size)
 
     # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key)
+    reporter = Reporter(interval, aggregator, target, api_key,
+        use_gzip=use_gzip, max_points_per_post=max_points_per_post,
+        max_post_size=max_post_size, spool=spool)
     reporter.start()
 
     # Start the server.
-    server_host = ''
-    server = Server(aggregator, server_host, port)
     server.start()
 
     # If we're here, we're done.
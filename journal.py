@@ -0,0 +1,228 @@
+'''
+An append-only on-disk journal of the transactions the forwarder holds.
+
+Each transaction is written as an ADD record when it's queued, and an ACK
+record is written once it's done with (sent, or evicted from the queue).
+Records go to segment files framed like the spool's. The oldest segments are
+deleted once all the transactions they added are acknowledged, and dropped
+if the journal would grow past its byte cap. Each record is handed to the
+OS as it's written, so it survives the forwarder being killed; it's synced
+to disk at most every sync interval, not for each record.
+'''
+
+import errno
+import logging
+import os
+import struct
+import time
+
+from spool import RECORD_HEADER, read_record, write_record
+
+logger = logging.getLogger('journal')
+
+# Records start with their type and the id of their transaction, an ADD
+# record is followed by the transaction's data.
+RECORD_PREFIX = struct.Struct('>cQ')
+ADD = 'A'
+ACK = 'K'
+SEGMENT_SUFFIX = '.journal'
+
+
+class Journal(object):
+    """
+    A journal of the string records of the transactions not yet acknowledged,
+    kept in `path`, holding at most `max_size` bytes in segments of about
+    `segment_size` bytes.
+
+    `load` must be called first: it returns the records left by the previous
+    run, then new records are appended with `add` and acknowledged with `ack`.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024,
+                 segment_size=4 * 1024 * 1024, sync_interval=1.0):
+        self.path = path
+        self.max_size = int(max_size)
+        self.segment_size = int(segment_size)
+        self.sync_interval = sync_interval
+
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Segment numbers, oldest first, their sizes and the number of
+        # transactions they added that aren't acknowledged.
+        self.segments = []
+        self.segment_sizes = {}
+        self.segment_live = {}
+        self.size = 0
+        # The segment of each transaction not acknowledged, by id
+        self._live = {}
+        self._next_id = 0
+
+        self._writer = None
+        self._writer_number = None
+        self._next_number = 0
+        # Whether records were written since the last sync, and when it was
+        self._dirty = False
+        self._synced = time.time()
+        # Transactions dropped because of the size cap
+        self.dropped = 0
+
+    def __len__(self):
+        """ Return the number of transactions not acknowledged. """
+        return len(self._live)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%020d%s' % (number, SEGMENT_SUFFIX))
+
+    def load(self):
+        """
+        Read the segments left by the previous run, and return the
+        (id, record) of the transactions they hold which weren't
+        acknowledged, oldest first. Corrupt records end their segment.
+        """
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        numbers.sort()
+
+        records = {}
+        for number in numbers:
+            self.segments.append(number)
+            self.segment_sizes[number] = os.path.getsize(self._segment_path(number))
+            self.segment_live[number] = 0
+            self.size += self.segment_sizes[number]
+
+            f = open(self._segment_path(number), 'rb')
+            try:
+                while True:
+                    record = read_record(f)
+                    if record is None or len(record) < RECORD_PREFIX.size:
+                        break
+                    record_type, tr_id = RECORD_PREFIX.unpack_from(record)
+                    self._next_id = max(self._next_id, tr_id + 1)
+                    if record_type == ADD:
+                        records[tr_id] = record[RECORD_PREFIX.size:]
+                        self._live[tr_id] = number
+                    elif record_type == ACK:
+                        records.pop(tr_id, None)
+                        self._live.pop(tr_id, None)
+            finally:
+                f.close()
+
+        for number in self._live.itervalues():
+            self.segment_live[number] += 1
+        self._next_number = (numbers[-1] + 1) if numbers else 0
+        self._remove_acknowledged()
+
+        if records:
+            logger.info("Loaded %s transactions from the journal" % len(records))
+        return [(tr_id, records[tr_id]) for tr_id in sorted(records)]
+
+    def add(self, record):
+        """
+        Append the record of a new transaction, and return the id to
+        acknowledge it with, or None if it's too big to be journaled.
+        """
+        record_size = RECORD_HEADER.size + RECORD_PREFIX.size + len(record)
+        if record_size > self.max_size:
+            logger.error("Transaction of %s bytes too big for the journal" % len(record))
+            return None
+
+        tr_id = self._next_id
+        self._next_id += 1
+        self._write(RECORD_PREFIX.pack(ADD, tr_id) + record)
+        self._live[tr_id] = self._writer_number
+        self.segment_live[self._writer_number] += 1
+        return tr_id
+
+    def ack(self, tr_id):
+        """ Acknowledge a transaction, it won't be loaded again. """
+        number = self._live.pop(tr_id, None)
+        if number is None:
+            # Dropped from the journal already
+            return
+        self.segment_live[number] -= 1
+        self._write(RECORD_PREFIX.pack(ACK, tr_id))
+        self._remove_acknowledged()
+
+    def _write(self, record):
+        record_size = RECORD_HEADER.size + len(record)
+        while self.segments and self.size + record_size > self.max_size:
+            self._drop_oldest()
+
+        if self._writer is None or self.segment_sizes[self._writer_number] >= self.segment_size:
+            self._start_segment()
+
+        written = write_record(self._writer, record)
+        self._writer.flush()
+        self.segment_sizes[self._writer_number] += written
+        self.size += written
+        self._dirty = True
+        if time.time() - self._synced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Sync the records written to disk. """
+        if self._dirty and self._writer is not None:
+            os.fsync(self._writer.fileno())
+        self._dirty = False
+        self._synced = time.time()
+
+    def _start_segment(self):
+        self._close_writer()
+        number = self._next_number
+        self._next_number += 1
+        self._writer = open(self._segment_path(number), 'ab')
+        self._writer_number = number
+        self.segments.append(number)
+        self.segment_sizes[number] = 0
+        self.segment_live[number] = 0
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self.sync()
+            self._writer.close()
+            self._writer = None
+            self._writer_number = None
+
+    def _remove_acknowledged(self):
+        """
+        Remove the oldest segments while all the transactions they added
+        are acknowledged. Only the oldest ones can go: the acknowledgements
+        they hold may be for transactions added by older segments.
+        """
+        while self.segments and self.segments[0] != self._writer_number and \
+                self.segment_live[self.segments[0]] == 0:
+            self._remove_oldest()
+
+    def _drop_oldest(self):
+        """ Drop the oldest segment, with the transactions not acknowledged. """
+        number = self.segments[0]
+        dropped = self.segment_live[number]
+        logger.warn("Journal full, dropping segment %s and its %s transactions" % (
+            self._segment_path(number), dropped))
+        for tr_id in [t for t, n in self._live.iteritems() if n == number]:
+            del self._live[tr_id]
+        self.dropped += dropped
+        self._remove_oldest()
+
+    def _remove_oldest(self):
+        number = self.segments.pop(0)
+        if number == self._writer_number:
+            self._close_writer()
+        self.size -= self.segment_sizes.pop(number)
+        del self.segment_live[number]
+        try:
+            os.remove(self._segment_path(number))
+        except OSError:
+            logger.exception("Error removing journal segment")
+
+    def close(self):
+        self._close_writer()
@@ -0,0 +1,190 @@
+'''
+A bounded, append-only on-disk queue of records.
+
+Records are appended to segment files, each record prefixed by its length
+and checksum, and replayed oldest-first. A segment is deleted once all of its
+records are replayed. When the spool would grow past its byte cap, the oldest
+segments are dropped to make room.
+'''
+
+import errno
+import logging
+import os
+import struct
+import zlib
+
+logger = logging.getLogger('spool')
+
+# Records are prefixed by their length and their CRC-32.
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.spool'
+
+
+def write_record(f, record):
+    """ Write a record with its header, return the bytes written. """
+    f.write(RECORD_HEADER.pack(len(record), zlib.crc32(record) & 0xffffffff))
+    f.write(record)
+    return RECORD_HEADER.size + len(record)
+
+
+def read_record(f):
+    """
+    Read the next record of a segment, or return None at its end or if the
+    rest of it is corrupt.
+    """
+    header = f.read(RECORD_HEADER.size)
+    if not header:
+        return None
+    if len(header) < RECORD_HEADER.size:
+        logger.error("Truncated record header in segment %s" % f.name)
+        return None
+    length, checksum = RECORD_HEADER.unpack(header)
+    record = f.read(length)
+    if len(record) < length or zlib.crc32(record) & 0xffffffff != checksum:
+        logger.error("Corrupt record in segment %s" % f.name)
+        return None
+    return record
+
+
+class Spool(object):
+    """
+    A queue of string records kept in `path`, holding at most `max_size`
+    bytes in segments of about `segment_size` bytes.
+
+    Replay is at-least-once: the position of the replay within a segment is
+    only kept in memory, so after a restart a partly replayed segment is
+    replayed again from its start.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024,
+                 segment_size=4 * 1024 * 1024):
+        self.path = path
+        self.max_size = int(max_size)
+        self.segment_size = int(segment_size)
+
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Segment numbers, oldest first, and their sizes.
+        self.segments = []
+        self.segment_sizes = {}
+        for name in os.listdir(path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    number = int(name[:-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                self.segments.append(number)
+                self.segment_sizes[number] = os.path.getsize(
+                    self._segment_path(number))
+        self.segments.sort()
+        self.size = sum(self.segment_sizes.values())
+
+        # The segment being appended to. A new one is always started, so we
+        # never append after a record left truncated by a crash.
+        self._writer = None
+        self._writer_number = None
+        self._next_number = (self.segments[-1] + 1) if self.segments else 0
+        # The replay position in the oldest segment.
+        self._read_offset = 0
+        # Records dropped because of the size cap.
+        self.dropped = 0
+
+    def __len__(self):
+        """ Return the number of segments. """
+        return len(self.segments)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%020d%s' % (number, SEGMENT_SUFFIX))
+
+    def append(self, record):
+        """
+        Append a record, dropping the oldest segments if the spool would
+        outgrow its size cap. Return whether the record was written.
+        """
+        record_size = RECORD_HEADER.size + len(record)
+        if record_size > self.max_size:
+            logger.error("Record of %s bytes bigger than the spool, dropped" % len(record))
+            self.dropped += 1
+            return False
+
+        while self.segments and self.size + record_size > self.max_size:
+            self._drop_oldest()
+
+        if self._writer is None or self.segment_sizes[self._writer_number] >= self.segment_size:
+            self._start_segment()
+
+        number = self._writer_number
+        write_record(self._writer, record)
+        self._writer.flush()
+        self.segment_sizes[number] += record_size
+        self.size += record_size
+        return True
+
+    def _start_segment(self):
+        self._close_writer()
+        number = self._next_number
+        self._next_number += 1
+        self._writer = open(self._segment_path(number), 'ab')
+        self._writer_number = number
+        self.segments.append(number)
+        self.segment_sizes[number] = 0
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._writer_number = None
+
+    def _drop_oldest(self):
+        """ Drop the oldest segment, with the records not yet replayed. """
+        number = self.segments[0]
+        logger.warn("Spool full, dropping segment %s" % self._segment_path(number))
+        self._remove_oldest()
+        self.dropped += 1
+
+    def _remove_oldest(self):
+        number = self.segments.pop(0)
+        if number == self._writer_number:
+            self._close_writer()
+        self.size -= self.segment_sizes.pop(number)
+        self._read_offset = 0
+        try:
+            os.remove(self._segment_path(number))
+        except OSError:
+            logger.exception("Error removing spool segment")
+
+    def replay(self, callback):
+        """
+        Call `callback` with the records, oldest first, until it returns
+        False. The records it accepted are removed from the spool. Return the
+        number of records accepted.
+        """
+        replayed = 0
+        while self.segments:
+            number = self.segments[0]
+            if number == self._writer_number:
+                # Let the writer start a new segment, this one will be
+                # removed once replayed.
+                self._close_writer()
+            f = open(self._segment_path(number), 'rb')
+            try:
+                f.seek(self._read_offset)
+                while True:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    if not callback(record):
+                        return replayed
+                    replayed += 1
+                    self._read_offset = f.tell()
+            finally:
+                f.close()
+            self._remove_oldest()
+        return replayed
+
+    def close(self):
+        self._close_writer()
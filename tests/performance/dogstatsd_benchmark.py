@@ -0,0 +1,257 @@
+"""
+Throughput and latency benchmark for dogstatsd. For every scenario (a target
+packet rate and a number of distinct contexts) it:
+    - runs a dogstatsd Server in a child process, flushing to a local stub
+      intake every interval,
+    - replays synthetic UDP traffic at the target rate from sender processes,
+    - reports the packets received per second, the drop rate (between what
+      was sent and what was received), the flush latency percentiles and the
+      resident memory of the server.
+
+Results are printed and written as JSON, to compare versions:
+
+    PYTHONPATH=. python tests/performance/dogstatsd_benchmark.py \\
+        --rates 10000,50000 --contexts 100,10000 --output results.json
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Event, Process, Queue
+from optparse import OptionParser
+import socket
+import sys
+import threading
+import time
+
+from config import get_version
+from dogstatsd import MetricsAggregator, Reporter, Server
+from util import json
+
+
+# The share of each metric type in the generated traffic.
+metric_types = ['c', 'c', 'g', 'h', 'ms', 's']
+
+
+class IntakeHandler(BaseHTTPRequestHandler):
+    """ Accepts everything, counting the posts and bytes received. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.rfile.read(length)
+        self.server.posts += 1
+        self.server.bytes += length
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_intake():
+    intake = HTTPServer(('127.0.0.1', 0), IntakeHandler)
+    intake.posts = 0
+    intake.bytes = 0
+    thread = threading.Thread(target=intake.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return intake
+
+
+def get_memory():
+    """ Return the current and peak resident memory of the process in bytes. """
+    memory = {}
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            memory['rss'] = int(line.split()[1]) * 1024
+        elif line.startswith('VmHWM:'):
+            memory['peak_rss'] = int(line.split()[1]) * 1024
+    return memory
+
+
+def percentile(values, p):
+    """ Return the value ranked round(p * count - 1) among the values. """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(round(p * len(values) - 1)), 0)]
+
+
+def run_server(options, ready, stop, results):
+    """
+    Run dogstatsd in the current (child) process until `stop` is set, then
+    put its stats on the `results` queue.
+    """
+    intake = start_intake()
+    aggregator = MetricsAggregator('my.host', options.interval)
+    server = Server(aggregator, '127.0.0.1', 0, so_rcvbuf=options.so_rcvbuf)
+    reporter = Reporter(options.interval, aggregator,
+        'http://127.0.0.1:%s' % intake.server_address[1])
+
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    ready.put(server.socket.getsockname()[1])
+
+    # Flush in this thread, timing each flush.
+    flush_durations = []
+    while not stop.is_set():
+        stop.wait(options.interval)
+        start = time.time()
+        reporter.flush()
+        flush_durations.append(time.time() - start)
+
+    results.put({
+        'received': aggregator.count,
+        'kernel_drops': server.get_kernel_drops(),
+        'flush_durations': flush_durations,
+        'intake_posts': intake.posts,
+        'intake_bytes': intake.bytes,
+        'memory': get_memory(),
+    })
+
+
+def build_packets(contexts, count=10000):
+    """ Return `count` packets spread over the given number of contexts. """
+    packets = []
+    for i in xrange(count):
+        context = i % contexts
+        metric_type = metric_types[context % len(metric_types)]
+        packets.append('bench.metric.%s:%s|%s|#context:%s,env:bench' % (
+            context % 100, i % 1000, metric_type, context))
+    return packets
+
+
+def send(port, rate, duration, contexts, sent):
+    """ Send packets at `rate` per second for `duration` seconds. """
+    packets = build_packets(contexts)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sendto = sock.sendto
+    address = ('127.0.0.1', port)
+
+    # Send bursts every tick, catching up if we fall behind.
+    tick = 0.01
+    start = time.time()
+    count = 0
+    i = 0
+    while True:
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+        target = int(rate * elapsed) + int(rate * tick)
+        while count < target:
+            try:
+                sendto(packets[i], address)
+            except socket.error:
+                # The local socket buffer is full, it's a drop too.
+                pass
+            count += 1
+            i = (i + 1) % len(packets)
+        time.sleep(tick)
+    sent.put(count)
+
+
+def run_scenario(options, rate, contexts):
+    ready, results, sent = Queue(), Queue(), Queue()
+    stop = Event()
+    server = Process(target=run_server, args=(options, ready, stop, results))
+    server.start()
+    port = ready.get()
+
+    senders = [Process(target=send, args=(port, float(rate) / options.senders,
+                       options.duration, contexts, sent))
+               for _ in xrange(options.senders)]
+    start = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    duration = time.time() - start
+    total_sent = sum(sent.get() for _ in senders)
+
+    # Let the server drain its buffer and flush once more.
+    time.sleep(1)
+    stop.set()
+    stats = results.get()
+    server.join()
+
+    flushes = stats['flush_durations']
+    received = stats['received']
+    return {
+        'target_rate': rate,
+        'contexts': contexts,
+        'duration': duration,
+        'sent': total_sent,
+        'received': received,
+        'packets_per_second': received / duration,
+        'drop_rate': 1 - float(received) / total_sent if total_sent else 0.0,
+        'kernel_drops': stats['kernel_drops'],
+        'flush_latency': {
+            'p50': percentile(flushes, 0.5),
+            'p90': percentile(flushes, 0.9),
+            'p99': percentile(flushes, 0.99),
+            'max': max(flushes) if flushes else None,
+        },
+        'intake_posts': stats['intake_posts'],
+        'intake_bytes': stats['intake_bytes'],
+        'rss': stats['memory'].get('rss'),
+        'peak_rss': stats['memory'].get('peak_rss'),
+    }
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rates', default='10000,50000,100000',
+        help='comma-separated packet rates to send, per second')
+    parser.add_option('--contexts', default='100,10000,100000',
+        help='comma-separated numbers of distinct contexts')
+    parser.add_option('--duration', type='float', default=10,
+        help='seconds of traffic per scenario')
+    parser.add_option('--interval', type='int', default=2,
+        help='aggregation and flush interval in seconds')
+    parser.add_option('--senders', type='int', default=2,
+        help='number of sending processes')
+    parser.add_option('--so-rcvbuf', type='int', default=None,
+        help='receive buffer size of the server socket')
+    parser.add_option('--output', default='dogstatsd_benchmark.json',
+        help='file to write the JSON results to')
+    options, _ = parser.parse_args()
+
+    rates = [int(r) for r in options.rates.split(',')]
+    context_counts = [int(c) for c in options.contexts.split(',')]
+
+    print "%8s %8s %10s %8s %10s %10s %10s" % ('rate', 'contexts',
+        'pps', 'drops', 'flush p50', 'flush p99', 'peak rss')
+    scenarios = []
+    for rate in rates:
+        for contexts in context_counts:
+            result = run_scenario(options, rate, contexts)
+            scenarios.append(result)
+            latency = result['flush_latency']
+            print "%8s %8s %10.0f %7.2f%% %9.3fs %9.3fs %8.1fMB" % (rate,
+                contexts, result['packets_per_second'],
+                result['drop_rate'] * 100, latency['p50'] or 0,
+                latency['p99'] or 0, (result['peak_rss'] or 0) / 1048576.0)
+            sys.stdout.flush()
+
+    f = open(options.output, 'w')
+    try:
+        json.dump({
+            'version': get_version(),
+            'timestamp': time.time(),
+            'options': {
+                'duration': options.duration,
+                'interval': options.interval,
+                'senders': options.senders,
+                'so_rcvbuf': options.so_rcvbuf,
+            },
+            'scenarios': scenarios,
+        }, f, indent=2)
+    finally:
+        f.close()
+    print "Results written to %s" % options.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Flush benchmark for dogstatsd. It compares, for growing numbers of contexts,
+the time it takes to flush and serialize a series payload:
+    - with `flush`, building a dict per point and JSON-encoding them all,
+    - with `flush_serialized`, encoding the points straight from the metrics.
+
+    PYTHONPATH=. python tests/performance/dogstatsd_flush.py [contexts ...]
+"""
+
+import gc
+import sys
+import time
+
+from dogstatsd import Counter, Gauge, Histogram, MetricsAggregator
+from util import json
+
+
+context_counts = [10000, 100000, 1000000]
+metric_classes = [Counter, Gauge, Histogram]
+
+
+def build_aggregator(count):
+    """
+    Return an aggregator holding a completed interval of `count` contexts,
+    evenly spread between counters, gauges and histograms.
+    """
+    aggregator = MetricsAggregator('my.host', 10)
+    contexts = {}
+    for i in xrange(count):
+        metric_class = metric_classes[i % len(metric_classes)]
+        metric = metric_class()
+        for value in xrange(5):
+            metric.sample(value, 1)
+        contexts[('metric.%s' % (i % 1000), ('tag:%s' % i,))] = metric
+    aggregator.generations[0] = contexts
+    return aggregator
+
+
+def dict_flush(aggregator):
+    metrics = aggregator.flush()
+    return json.dumps({"series": metrics})
+
+
+def serialized_flush(aggregator):
+    series = aggregator.flush_serialized()
+    return '{"series":[' + ','.join(series) + ']}'
+
+
+def measure(count, flush):
+    aggregator = build_aggregator(count)
+    gc.collect()
+    start = time.time()
+    body = flush(aggregator)
+    return time.time() - start, len(body)
+
+
+def main(counts):
+    print "%10s %14s %14s %8s" % ('contexts', 'dicts (s)', 'serialized (s)', 'speedup')
+    for count in counts:
+        dict_duration, _ = measure(count, dict_flush)
+        serialized_duration, _ = measure(count, serialized_flush)
+        print "%10s %14.3f %14.3f %7.1fx" % (count, dict_duration,
+            serialized_duration, dict_duration / serialized_duration)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        context_counts = [int(c) for c in sys.argv[1:]]
+    main(context_counts)
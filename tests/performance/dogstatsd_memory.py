@@ -0,0 +1,94 @@
+"""
+Memory benchmark for dogstatsd metric objects. It creates a large number of
+contexts and reports the resident memory used per context, with the current
+metric classes and with the previous layout (plain objects holding their own
+name, tags and hostname).
+
+    PYTHONPATH=. python tests/performance/dogstatsd_memory.py [contexts]
+"""
+
+import gc
+import os
+import sys
+
+from dogstatsd import Counter, Gauge, Histogram
+
+
+context_count = 200000
+hostname = 'my.host'
+
+
+class DictGauge(object):
+    """ A gauge with the layout metrics had before they used __slots__. """
+
+    def __init__(self, name, tags, hostname):
+        self.name = name
+        self.value = None
+        self.tags = tags
+        self.hostname = hostname
+
+
+class DictCounter(object):
+    """ A counter with the layout metrics had before they used __slots__. """
+
+    def __init__(self, name, tags, hostname):
+        self.name = name
+        self.value = 0
+        self.tags = tags
+        self.hostname = hostname
+
+
+def get_rss():
+    """ Return the resident memory of the process in bytes. """
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    raise Exception('VmRSS not found in /proc/self/status')
+
+
+def measure(contexts, factory):
+    """
+    Return the bytes used per context by the metrics built by factory. It's
+    measured in a forked child, so memory freed by previous measures (which
+    the interpreter keeps around) doesn't skew the result.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        before = get_rss()
+        metrics = dict((context, factory(context)) for context in contexts)
+        after = get_rss()
+        os.write(write_fd, str(float(after - before) / len(metrics)))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result)
+
+
+def main(count):
+    # The contexts are built once so that only the metrics are measured.
+    contexts = [(0, 'metric.%s' % (i % 100), ('tag:%s' % i,))
+                for i in xrange(count)]
+
+    layouts = [
+        ('gauge (dict)', lambda c: DictGauge(c[1], c[2], hostname)),
+        ('gauge (slots)', lambda c: Gauge()),
+        ('counter (dict)', lambda c: DictCounter(c[1], c[2], hostname)),
+        ('counter (slots)', lambda c: Counter()),
+        ('histogram (slots)', lambda c: Histogram()),
+    ]
+
+    print "%s contexts" % count
+    for name, factory in layouts:
+        print "%-20s %8.1f bytes/context" % (name, measure(contexts, factory))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        context_count = int(sys.argv[1])
+    main(context_count)
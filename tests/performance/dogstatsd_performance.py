@@ -1,24 +1,37 @@
 """
 Performance tests to help profile dogstatsd. It does away with threads for easy
-profiling.
+profiling. See dogstatsd_benchmark.py to measure a running server.
 """
 
+import time
+
 from dogstatsd import MetricsAggregator
-from multiprocessing import Process
 
 
 flush_count = 10
 loops_per_flush = 10000
 metric_count = 5
+batch_size = 1000
 
 
-aggregator = MetricsAggregator('my.host')
+aggregator = MetricsAggregator('my.host', 10)
 
+start = time.time()
 for _ in xrange(flush_count):
+    # Submit packets in batches, as the server does.
+    packets = []
     for i in xrange(loops_per_flush):
-        # Counters
         for j in xrange(metric_count):
-            aggregator.submit('counter.%s:%s|c' % (j, i))
-            aggregator.submit('gauge.%s:%s|g' % (j, i))
-            aggregator.submit('histogram.%s:%s|h' % (j, i))
+            packets.append('counter.%s:%s|c' % (j, i))
+            packets.append('gauge.%s:%s|g' % (j, i))
+            packets.append('histogram.%s:%s|h' % (j, i))
+            if len(packets) >= batch_size:
+                aggregator.submit_packets(packets)
+                packets = []
+    aggregator.submit_packets(packets)
     aggregator.flush()
+
+duration = time.time() - start
+submitted = flush_count * loops_per_flush * metric_count * 3
+print "%s packets in %.2fs, %.0f packets/s" % (submitted, duration,
+    submitted / duration)
@@ -0,0 +1,59 @@
+"""
+Benchmark for the forwarder's TransactionManager. It queues a growing number
+of small transactions, past the queue size limit so that old ones are
+evicted, then completes them all, and reports the time taken by each step.
+
+    PYTHONPATH=. python tests/performance/transaction_queue.py [count ...]
+"""
+
+from datetime import timedelta
+import logging
+import sys
+import time
+
+from transaction import Transaction, TransactionManager
+
+
+transaction_counts = [10000, 50000, 200000]
+
+
+class SizedTransaction(Transaction):
+
+    def __init__(self, size):
+        Transaction.__init__(self)
+        self._size = size
+
+    def flush(self):
+        pass
+
+
+def measure(count):
+    # Only keep room for half of the transactions.
+    manager = TransactionManager(timedelta(seconds=0), count * 100 / 2,
+        timedelta(seconds=0))
+
+    start = time.time()
+    for _ in xrange(count):
+        manager.append(SizedTransaction(100))
+    append_duration = time.time() - start
+
+    start = time.time()
+    for tr in manager.get_transactions():
+        manager.tr_success(tr)
+    success_duration = time.time() - start
+    return append_duration, success_duration
+
+
+def main(counts):
+    # The manager logs every operation.
+    logging.disable(logging.CRITICAL)
+    print "%12s %12s %12s" % ('transactions', 'append (s)', 'success (s)')
+    for count in counts:
+        append_duration, success_duration = measure(count)
+        print "%12s %12.3f %12.3f" % (count, append_duration, success_duration)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        transaction_counts = [int(c) for c in sys.argv[1:]]
+    main(transaction_counts)
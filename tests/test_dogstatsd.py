@@ -1,10 +1,62 @@
 
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from hashlib import md5
+import os
 import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import time
 
 import nose.tools as nt
 
-from dogstatsd import MetricsAggregator
+from dogstatsd import HyperLogLog, LRUCache, MetricFilter, MetricsAggregator, \
+    PrefixTrie, QuantileSketch, Reporter, Server, SpaceSaving
+from spool import Spool
+from util import json, gzip_decompress
+
+
+class IntakeHandler(BaseHTTPRequestHandler):
+    """ Records the series posted to a stub intake. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip_decompress(body)
+        # Answer with the queued statuses first, if any.
+        status = 202
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        if status < 400:
+            self.server.posts.append((self.client_address, self.path,
+                json.loads(body)))
+        time.sleep(self.server.delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        # Close the kept-alive connection without telling the client, as
+        # servers do when it's idle for too long.
+        if self.server.close_connections:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+def start_intake():
+    server = HTTPServer(('127.0.0.1', 0), IntakeHandler)
+    server.posts = []
+    server.statuses = []
+    server.delay = 0
+    server.close_connections = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
 
 
 class TestUnitDogStatsd(object):
@@ -86,6 +138,38 @@ class TestUnitDogStatsd(object):
         assert m['metric'] == 'sampled.counter'
         nt.assert_equal(m['points'][0][1], 2)
 
+    def test_non_integer_sample_rate(self):
+        stats = MetricsAggregator('myhost', 1)
+        for i in xrange(3):
+            stats.submit('sampled.counter:1|c|@0.3')
+            stats.submit('sampled.hist:1|h|@0.3')
+        time.sleep(1)
+        metrics = dict((m['metric'], m['points'][0][1])
+            for m in stats.flush(False))
+        assert abs(metrics['sampled.counter'] - 10) < 1e-6
+        assert abs(metrics['sampled.hist.count'] - 10) < 1e-6
+
+    def test_adaptive_sampling(self):
+        stats = MetricsAggregator('myhost', 1, adaptive_sampling_threshold=1000)
+        # Submit everything within the same interval.
+        time.sleep(1 - time.time() % 1)
+        for i in xrange(10000):
+            stats.submit('busy.counter:1|c')
+            stats.submit('busy.hist:1|h')
+        stats.submit('quiet.counter:1|c')
+        time.sleep(1)
+
+        metrics = dict(((m['metric'], m['tags']), m['points'][0][1])
+            for m in stats.flush(False))
+        # The totals are still estimated right.
+        assert abs(metrics[('busy.counter', None)] - 10000) < 10000 * 0.15
+        assert abs(metrics[('busy.hist.count', None)] - 10000) < 10000 * 0.15
+        nt.assert_equal(metrics[('quiet.counter', None)], 1)
+        # And the rates applied are reported.
+        rate = metrics[('dd.dogstatsd.adaptive_sample_rate', ('metric:busy.counter',))]
+        assert 0.1 <= rate < 0.11, rate
+        assert ('dd.dogstatsd.adaptive_sample_rate', ('metric:quiet.counter',)) not in metrics
+
     def test_gauge(self):
         stats = MetricsAggregator('myhost', 1)
 
@@ -184,6 +268,7 @@ class TestUnitDogStatsd(object):
             'unknown.type:2|z',
             'string.value:abc|c',
             'string.sample.rate:0|c|@abc',
+            'zero.sample.rate:1|c|@0',
         ]
 
         stats = MetricsAggregator('myhost', 1)
@@ -200,11 +285,656 @@ class TestUnitDogStatsd(object):
         for i in xrange(10):
             stats.submit('metric:10|c')
         time.sleep(1)
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['metric']['points'][0][1], 100)
+        nt.assert_equal(metrics['dd.dogstatsd.packet.count']['points'][0][1], 10)
+
+    def test_internal_stats(self):
+        stats = MetricsAggregator('myhost', 1)
+        stats.submit_packets([
+            'my.counter:1|c',
+            'my.counter:1|c|#a',
+            'my.counter:2|c',
+            'no.type:1',
+            'bad.value:abc|c',
+            'bad.type:1|z',
+            'bad.type:1|y',
+            'bad.rate:1|c|@2',
+        ])
+        time.sleep(1)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['dd.dogstatsd.contexts'], 2)
+        nt.assert_equal(metrics['dd.dogstatsd.contexts.created'], 2)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_error.format'], 1)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_error.value'], 1)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_error.type'], 2)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_error.sample_rate'], 1)
+
+        # They're reported by difference with the last flush.
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['dd.dogstatsd.contexts'], 0)
+        nt.assert_equal(metrics['dd.dogstatsd.contexts.created'], 0)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_error.type'], 0)
+
+    def test_submit_packets(self):
+        stats = MetricsAggregator('myhost', 1)
+        # A bad packet shouldn't prevent the rest of the batch from being
+        # submitted.
+        stats.submit_packets(['my.counter:1|c', 'bad.packet', 'my.counter:2|c'])
+        time.sleep(1)
+        metrics = stats.flush(False)
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 3)
+
+    def test_diagnostic_sources(self):
+        stats = MetricsAggregator('myhost', 1)
+        stats.add_diagnostic_source(lambda: [('dd.dogstatsd.udp.drops', 4)])
+        metrics = stats.flush()
+        drops = [m for m in metrics if m['metric'] == 'dd.dogstatsd.udp.drops']
+        nt.assert_equal(len(drops), 1)
+        nt.assert_equal(drops[0]['points'][0][1], 4)
+        nt.assert_equal(drops[0]['host'], 'myhost')
+
+    def test_multi_metric_packets(self):
+        stats = MetricsAggregator('myhost', 1)
+        stats.submit('my.counter:1|c\nmy.gauge:5|g\nmy.counter:2|c\n')
+        time.sleep(1)
+        metrics = self.sort_metrics(stats.flush(False))
+        nt.assert_equal(len(metrics), 2)
+        counter, gauge = metrics
+        nt.assert_equal(counter['metric'], 'my.counter')
+        nt.assert_equal(counter['points'][0][1], 3)
+        nt.assert_equal(gauge['metric'], 'my.gauge')
+        nt.assert_equal(gauge['points'][0][1], 5)
+
+    def test_multi_metric_packets_bad_lines(self):
+        stats = MetricsAggregator('myhost', 1)
+        try:
+            stats.submit('my.counter:1|c\nbad.line\nmy.counter:2|c\nbad:x|c')
+        except Exception, e:
+            # Each bad line is reported.
+            assert 'bad.line' in str(e)
+            assert 'bad:x|c' in str(e)
+        else:
+            assert False, 'bad lines were not reported'
+
+        # And the valid ones are still aggregated.
+        time.sleep(1)
+        metrics = stats.flush(False)
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 3)
+
+    def test_export_and_merge(self):
+        # Two aggregators, e.g. in two worker processes.
+        first = MetricsAggregator('myhost', 1)
+        second = MetricsAggregator('myhost', 1)
+        for stats in (first, second):
+            stats.submit('my.counter:1|c')
+            stats.submit('my.gauge:%s|g' % id(stats))
+            for i in xrange(50):
+                stats.submit('my.hist:%s|h' % i)
+        second.submit('my.other.counter:1|c|#tag')
+
+        time.sleep(1)
+        stats = MetricsAggregator('myhost', 1)
+        stats.merge(first.export())
+        stats.merge(second.export())
+
         metrics = self.sort_metrics(stats.flush())
-        nt.assert_equals(2, len(metrics))
+        by_name = dict((m['metric'], m) for m in metrics)
+        nt.assert_equal(by_name['dd.dogstatsd.packet.count']['points'][0][1], 105)
+        nt.assert_equal(by_name['my.counter']['points'][0][1], 2)
+        nt.assert_equal(by_name['my.other.counter']['points'][0][1], 1)
+        nt.assert_equal(by_name['my.other.counter']['tags'], ('tag',))
+        nt.assert_equal(by_name['my.gauge']['points'][0][1], id(second))
+        nt.assert_equal(by_name['my.hist.count']['points'][0][1], 100)
+        nt.assert_equal(by_name['my.hist.max']['points'][0][1], 49)
+
+        # Exporting leaves nothing behind.
+        assert not first.flush(False)
+        assert not stats.flush(False)
+
+    def test_histogram_avg_is_the_mean(self):
+        stats = MetricsAggregator('myhost', 1)
+        for value in [1, 2, 3, 100]:
+            stats.submit('my.hist:%s|h' % value)
+        time.sleep(1)
+        metrics = dict((m['metric'], m) for m in stats.flush(False))
+        nt.assert_equal(metrics['my.hist.avg']['points'][0][1], 26.5)
+
+    def test_quantile_sketch_accuracy(self):
+        values = [random.lognormvariate(0, 2) for _ in xrange(10000)]
+        values += [-v for v in values[:1000]] + [0] * 100
+
+        sketch = QuantileSketch()
+        for v in values:
+            sketch.add(v)
+
+        values.sort()
+        quantiles = [0, 0.1, 0.5, 0.75, 0.85, 0.95, 0.99, 1]
+        for q, estimate in zip(quantiles, sketch.quantiles(quantiles)):
+            exact = values[max(int(round(q * len(values) - 1)), 0)]
+            assert abs(estimate - exact) <= abs(exact) * QuantileSketch.RELATIVE_ACCURACY, \
+                "%s: %s %s" % (q, estimate, exact)
+
+    def test_quantile_sketch_merge(self):
+        first, second, both = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for i in xrange(1, 1001):
+            (first if i % 2 else second).add(i)
+            both.add(i)
+        first.merge(second)
+        quantiles = [0.5, 0.99]
+        nt.assert_equal(first.quantiles(quantiles), both.quantiles(quantiles))
+        nt.assert_equal(first.count, 1000)
+
+    def test_adaptive_sampling_percentiles(self):
+        stats = MetricsAggregator('myhost', 1, adaptive_sampling_threshold=1000)
+        time.sleep(1 - time.time() % 1)
+        # The distribution changes during the interval: the points sampled
+        # late are weighted up, so the first ones, all kept, don't skew it.
+        for i in xrange(20000):
+            stats.submit('busy.hist:%s|h' % (1 if i < 8000 else 100))
+        time.sleep(1)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush(False))
+        assert abs(metrics['busy.hist.75percentile'] - 100) <= 1
+        assert abs(metrics['busy.hist.avg'] - 60.4) < 60.4 * 0.15
+
+    def test_quantile_sketch_weights(self):
+        sketch = QuantileSketch()
+        sketch.add(1, 3)
+        sketch.add(10)
+        sketch.add(0, 0.5)
+        nt.assert_equal(sketch.count, 4.5)
+        values = sketch.quantiles([0.1, 0.5, 1])
+        nt.assert_equal(values[0], 0)
+        assert abs(values[1] - 1) <= QuantileSketch.RELATIVE_ACCURACY
+        assert abs(values[2] - 10) <= 10 * QuantileSketch.RELATIVE_ACCURACY
+
+    def test_quantile_sketch_memory_is_bounded(self):
+        sketch = QuantileSketch()
+        for i in xrange(10000):
+            sketch.add(1.05 ** i)
+        assert len(sketch.positive) <= QuantileSketch.MAX_BUCKETS
+        nt.assert_equal(sketch.count, 10000)
+        # The highest quantiles are still accurate.
+        top = sketch.quantiles([1])[0]
+        assert abs(top - 1.05 ** 9999) <= 1.05 ** 9999 * QuantileSketch.RELATIVE_ACCURACY
+
+    def test_set(self):
+        stats = MetricsAggregator('myhost', 1)
+        for user in ['alice', 'bob', 'alice', '1.5', '1.50', 'carol']:
+            stats.submit('my.set:%s|s' % user)
+        stats.submit('my.set:alice|s|#a')
+        time.sleep(1)
+        metrics = self.sort_metrics(stats.flush(include_diagnostic_stats=False))
+        nt.assert_equal(len(metrics), 2)
         first, second = metrics
+        nt.assert_equal(first['metric'], 'my.set')
+        nt.assert_equal(first['points'][0][1], 5)
+        nt.assert_equal(second['tags'], ('a',))
+        nt.assert_equal(second['points'][0][1], 1)
 
-        print metrics
+    def test_large_set_is_estimated(self):
+        stats = MetricsAggregator('myhost', 1)
+        for i in xrange(20000):
+            stats.submit('my.set:user%s|s' % (i % 10000))
+        time.sleep(1)
+        metrics = stats.flush(include_diagnostic_stats=False)
+        estimate = metrics[0]['points'][0][1]
+        assert abs(estimate - 10000) <= 10000 * 0.05, estimate
+
+    def test_hyperloglog_ranks(self):
+        hll = HyperLogLog()
+        registers = bytearray(HyperLogLog.REGISTERS)
+        for i in xrange(1000):
+            hll.add(str(i))
+            x = struct.unpack('<Q', md5(str(i)).digest()[:8])[0]
+            index = x >> HyperLogLog.RANK_BITS
+            rank = HyperLogLog.RANK_BITS - (x & HyperLogLog.RANK_MASK).bit_length() + 1
+            registers[index] = max(registers[index], rank)
+        nt.assert_equal(hll.registers, registers)
+
+    def test_hyperloglog_merge(self):
+        first, second, both = HyperLogLog(), HyperLogLog(), HyperLogLog()
+        for i in xrange(5000):
+            (first if i % 2 else second).add(str(i))
+            both.add(str(i))
+        first.merge(second)
+        nt.assert_equal(first.cardinality(), both.cardinality())
+        assert abs(first.cardinality() - 5000) <= 5000 * 0.05
+
+    def test_set_export_and_merge(self):
+        worker1 = MetricsAggregator('myhost', 1)
+        worker2 = MetricsAggregator('myhost', 1)
+        reporter = MetricsAggregator('myhost', 1)
+        for i in xrange(300):
+            worker1.submit('my.set:%s|s' % i)
+        for i in xrange(100, 200):
+            worker2.submit('my.set:%s|s' % i)
+        time.sleep(1)
+        # An exact set merged into an estimated one, and the opposite.
+        reporter.merge(worker2.export())
+        reporter.merge(worker1.export())
+        metrics = reporter.flush(include_diagnostic_stats=False)
+        estimate = metrics[0]['points'][0][1]
+        assert abs(estimate - 300) <= 300 * 0.05, estimate
+
+    def test_parse_cache(self):
+        stats = MetricsAggregator('myhost', 1)
+        for i in xrange(10):
+            stats.submit('my.counter:%s|c|#b,a' % i)
+            stats.submit('my.counter:%s|c|#a,b' % i)
+        time.sleep(1)
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['dd.dogstatsd.parse_cache.hits']['points'][0][1], 18)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_cache.misses']['points'][0][1], 2)
+        # Both tag orders are cached under different keys but still map to
+        # the same context.
+        nt.assert_equal(metrics['my.counter']['tags'], ('a', 'b'))
+        nt.assert_equal(metrics['my.counter']['points'][0][1], 90)
+
+        # The stats are reported since the last flush.
+        stats.submit('my.counter:1|c|#a,b')
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['dd.dogstatsd.parse_cache.hits']['points'][0][1], 1)
+        nt.assert_equal(metrics['dd.dogstatsd.parse_cache.misses']['points'][0][1], 0)
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie(['app.', 'web.req', 'web.'])
+        assert trie.matches('app.requests')
+        assert trie.matches('web.')
+        assert not trie.matches('app')
+        assert not trie.matches('db.app.requests')
+        assert not PrefixTrie().matches('app')
+        assert PrefixTrie(['']).matches('app')
+
+    def test_metric_filter(self):
+        metric_filter = MetricFilter(allow=['app.', 'web.'], deny=['app.debug.'],
+            strip_tags=['request_id'], max_tag_values=2)
+        stats = MetricsAggregator('myhost', 1, metric_filter=metric_filter)
+        stats.submit_packets([
+            'app.requests:1|c|#env:prod,request_id:1',
+            'app.requests:1|c|#env:prod,request_id:2',
+            'app.debug.queries:1|c',
+            'db.queries:1|c',
+            'web.users:1|c|#user:1',
+            'web.users:1|c|#user:2',
+            # Past the limit of values of the user tag.
+            'web.users:1|c|#user:3',
+            'web.users:1|c|#user:3',
+            'web.users:1|c|#user:1',
+        ])
+        time.sleep(1)
+        metrics = dict(((m['metric'], m['tags']), m['points'][0][1])
+                       for m in stats.flush())
+        nt.assert_equal(metrics[('app.requests', ('env:prod',))], 2)
+        nt.assert_equal(metrics[('web.users', ('user:1',))], 2)
+        nt.assert_equal(metrics[('web.users', ('user:2',))], 1)
+        nt.assert_false(('web.users', ('user:3',)) in metrics)
+        nt.assert_false(('db.queries', None) in metrics)
+        nt.assert_false(('app.debug.queries', None) in metrics)
+        nt.assert_equal(metrics[('dd.dogstatsd.filter.dropped.allow', None)], 1)
+        nt.assert_equal(metrics[('dd.dogstatsd.filter.dropped.deny', None)], 1)
+        nt.assert_equal(metrics[('dd.dogstatsd.filter.dropped.cardinality', None)], 2)
+        # No context was created for what was dropped.
+        nt.assert_equal(metrics[('dd.dogstatsd.contexts.created', None)], 3)
+
+    def test_context_limit(self):
+        stats = MetricsAggregator('myhost', 1, max_contexts_per_metric=3)
+        packets = ['my.counter:1|c|#request:%s' % i for i in xrange(1000)]
+        packets += ['my.counter:1|c|#request:7'] * 10
+        # Untagged points are folded too.
+        packets += ['my.counter:1|c']
+        packets += ['other.counter:1|c|#request:%s' % i for i in xrange(3)]
+        stats.submit_packets(packets)
+        # Memory stays bounded.
+        nt.assert_equal(len(stats._generation[1]), 3 + 1 + 1 + 3)
+        time.sleep(1)
 
-        nt.assert_equal(first['metric'], 'dd.dogstatsd.packet.count')
-        nt.assert_equal(first['points'][0][1], 10)
+        metrics = dict(((m['metric'], m['tags']), m['points'][0][1])
+                       for m in stats.flush())
+        nt.assert_equal(metrics[('my.counter', ('request:0',))], 1)
+        nt.assert_equal(metrics[('my.counter', ('overflow:true',))], 1008)
+        nt.assert_equal(metrics[('dd.dogstatsd.context_overflow',
+                                 ('metric:my.counter',))], 1008)
+        nt.assert_equal(metrics[('dd.dogstatsd.context_overflow.metrics', None)], 1)
+        nt.assert_equal(metrics[('other.counter', ('request:2',))], 1)
+        nt.assert_false(('other.counter', ('overflow:true',)) in metrics)
+
+    def test_space_saving(self):
+        top = SpaceSaving(5)
+        stream = ['a'] * 50 + ['b'] * 30 + [str(i) for i in xrange(60)]
+        random.shuffle(stream)
+        for item in stream:
+            top.add(item)
+        # Items more frequent than 1/k are always tracked.
+        items = [item for item, count in top.top()]
+        nt.assert_equal(len(items), 5)
+        assert 'a' in items and 'b' in items
+        # Counts are never under-estimated.
+        nt.assert_true(dict(top.top())['a'] >= 50)
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        nt.assert_equal(cache.get('a'), 1)
+        # 'b' is now the least recently used entry.
+        cache.set('c', 3)
+        nt.assert_equal(len(cache), 2)
+        nt.assert_equal(cache.get('b'), None)
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.get('c'), 3)
+
+    def test_no_parse_cache(self):
+        stats = MetricsAggregator('myhost', 1, parse_cache_size=0)
+        stats.submit_packets(['my.counter:1|c', 'my.counter:2|c'])
+        time.sleep(1)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['my.counter'], 3)
+        nt.assert_false('dd.dogstatsd.parse_cache.misses' in metrics)
+
+    def test_flush_only_completed_intervals(self):
+        stats = MetricsAggregator('myhost', 3600)
+        stats.submit('my.counter:1|c')
+        # The interval isn't over yet, nothing to flush.
+        assert not stats.flush(False)
+        nt.assert_equal(len(stats.generations), 1)
+
+        # Once it's over, the whole generation goes at once.
+        _, finished, _ = stats.pop_finished(time.time() + 3600)
+        nt.assert_equal(len(finished), 1)
+        interval, contexts = finished[0]
+        nt.assert_equal(contexts.keys(), [('my.counter', None)])
+        assert not stats.generations
+
+    def test_metrics_are_recycled(self):
+        stats = MetricsAggregator('myhost', 1)
+        stats.submit_packets(['my.counter:1|c', 'my.hist:1|h', 'idle:1|c'])
+        counter = stats._generation[1][('my.counter', None)]
+        time.sleep(1)
+        stats.flush()
+        # The metrics flushed are recycled by the next flush.
+        stats.flush()
+
+        stats.submit_packets(['my.counter:2|c', 'my.hist:2|h'])
+        nt.assert_true(stats._generation[1][('my.counter', None)] is counter)
+        time.sleep(1)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        # Values were reset, and no context was created.
+        nt.assert_equal(metrics['my.counter'], 2)
+        nt.assert_equal(metrics['my.hist.count'], 1)
+        nt.assert_equal(metrics['my.hist.min'], 2)
+        nt.assert_equal(metrics['dd.dogstatsd.contexts.created'], 0)
+        # Idle contexts aren't flushed.
+        nt.assert_false('idle' in metrics)
+
+    def test_merge_into_own_generation(self):
+        worker = MetricsAggregator('myhost', 1)
+        stats = MetricsAggregator('myhost', 1)
+        worker.submit('my.counter:1|c')
+        stats.submit('my.counter:2|c')
+        time.sleep(1)
+
+        # The exported generation is combined with the aggregator's own
+        # generation of the same interval at flush time.
+        stats.merge(worker.export())
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['my.counter']['points'][0][1], 3)
+        nt.assert_equal(metrics['dd.dogstatsd.packet.count']['points'][0][1], 2)
+
+
+    def test_flush_serialized(self):
+        packets = [
+            'my.counter:1|c|#b,a',
+            'my.gauge:0.1|g',
+            'my.hist:2|h',
+            'my.hist:4|h',
+            'my.%\\"odd"%s\\name:1|c',
+        ]
+        stats = MetricsAggregator('my"host', 1)
+        serialized_stats = MetricsAggregator('my"host', 1)
+        for packet in packets:
+            stats.submit(packet)
+            serialized_stats.submit(packet)
+        time.sleep(1)
+
+        # Both flushes give the same series.
+        metrics = self.sort_metrics(stats.flush())
+        serialized = self.sort_metrics(
+            [json.loads(s) for s in serialized_stats.flush_serialized()])
+
+        nt.assert_equal(len(serialized), len(metrics))
+        for expected, actual in zip(metrics, serialized):
+            nt.assert_equal(actual['metric'], expected['metric'])
+            nt.assert_equal(actual['host'], 'my"host')
+            nt.assert_equal(actual['tags'], expected['tags'] and list(expected['tags']))
+            nt.assert_equal(actual['points'][0][1], expected['points'][0][1])
+
+
+class TestReporter(object):
+
+    def setUp(self):
+        self.intake = start_intake()
+        self.url = 'http://127.0.0.1:%s' % self.intake.server_address[1]
+
+    def tearDown(self):
+        self.intake.shutdown()
+        self.intake.server_close()
+
+    def test_keep_alive_and_gzip(self):
+        reporter = Reporter(10, None, self.url, 'apikey')
+        series = [{'metric': 'my.counter', 'points': [(1, 2)], 'tags': None,
+                   'host': 'myhost'}]
+        reporter.submit(series)
+        reporter.submit(series)
+
+        posts = self.intake.posts
+        nt.assert_equal(len(posts), 2)
+        # Both posts went over the same connection.
+        nt.assert_equal(posts[0][0], posts[1][0])
+        nt.assert_equal(posts[0][1], '/api/v1/series?api_key=apikey')
+        nt.assert_equal(posts[0][2]['series'][0]['metric'], 'my.counter')
+
+    def test_reporter_stats(self):
+        aggregator = MetricsAggregator('myhost', 1)
+        reporter = Reporter(10, aggregator, self.url)
+        aggregator.submit('my.counter:1|c')
+        time.sleep(1)
+        reporter.flush()
+        reporter.flush()
+        reporter.close_connection()
+
+        # The second flush reports on the first one.
+        metrics = dict((m['metric'], m['points'][0][1])
+                       for m in self.intake.posts[1][2]['series'])
+        assert metrics['dd.dogstatsd.flush.duration'] > 0
+        assert metrics['dd.dogstatsd.serialization.duration'] > 0
+        assert metrics['dd.dogstatsd.http.latency'] > 0
+        assert metrics['dd.dogstatsd.payload.bytes'] > 0
+
+    def test_reconnect_on_error(self):
+        reporter = Reporter(10, None, self.url, use_gzip=False)
+        series = [{'metric': 'my.counter', 'points': [(1, 2)], 'tags': None,
+                   'host': 'myhost'}]
+        # The intake closes the kept-alive connection, the next post opens a
+        # new one.
+        self.intake.close_connections = True
+        reporter.submit(series)
+        self.intake.close_connections = False
+        time.sleep(0.1)
+        reporter.submit(series)
+
+        posts = self.intake.posts
+        nt.assert_equal(len(posts), 2)
+        assert posts[0][0] != posts[1][0]
+
+    def test_no_retry_on_read_timeout(self):
+        reporter = Reporter(10, None, self.url, read_timeout=0.5)
+        series = [{'metric': 'my.counter', 'points': [(1, 2)], 'tags': None,
+                   'host': 'myhost'}]
+        reporter.submit(series)
+        # The intake answers too late on the kept-alive connection: the post
+        # may have been processed, it's not sent again.
+        self.intake.delay = 1
+        nt.assert_raises(socket.timeout, reporter.submit_chunk,
+                         json.dumps({'series': series}))
+        time.sleep(1.5)
+        nt.assert_equal(len(self.intake.posts), 2)
+        self.intake.delay = 0
+
+    @staticmethod
+    def make_series(count):
+        return [{'metric': 'my.metric.%s' % i, 'points': [(1, i)],
+                 'tags': None, 'host': 'myhost'} for i in xrange(count)]
+
+    def test_chunks(self):
+        reporter = Reporter(10, None, self.url, max_points_per_post=3)
+        reporter.submit(self.make_series(10))
+
+        posts = self.intake.posts
+        nt.assert_equal([len(p[2]['series']) for p in posts], [3, 3, 3, 1])
+        # Chunks are sent in order.
+        values = [m['points'][0][1] for p in posts for m in p[2]['series']]
+        nt.assert_equal(values, range(10))
+
+    def test_chunks_size_cap(self):
+        series = self.make_series(8)
+        max_post_size = len(json.dumps({'series': series})) / 3
+        reporter = Reporter(10, None, self.url, max_post_size=max_post_size)
+        bodies = list(reporter.chunk([json.dumps(m) for m in series]))
+        nt.assert_equal(len(bodies), 4)
+        for body in bodies:
+            assert len(body) <= max_post_size
+
+        reporter.submit(series)
+        posts = self.intake.posts
+        values = [m['points'][0][1] for p in posts for m in p[2]['series']]
+        nt.assert_equal(values, range(8))
+
+    def test_chunk_retries(self):
+        reporter = Reporter(10, None, self.url, max_points_per_post=2,
+            chunk_retries=1)
+        # The first chunk fails once then succeeds, the second one fails for
+        # good, the last one goes through.
+        self.intake.statuses = [500, 202, 500, 500]
+        reporter.submit(self.make_series(6))
+
+        posts = self.intake.posts
+        values = [m['points'][0][1] for p in posts for m in p[2]['series']]
+        nt.assert_equal(values, [0, 1, 4, 5])
+
+        # Refused payloads aren't retried.
+        self.intake.statuses = [400]
+        assert not reporter.submit_chunk('{"series":[]}')
+        nt.assert_equal(len(self.intake.posts), 2)
+
+    def test_spool(self):
+        path = tempfile.mkdtemp()
+        try:
+            spool = Spool(path)
+            reporter = Reporter(10, None, self.url, max_points_per_post=2,
+                chunk_retries=0, spool=spool)
+            # The second chunk can't be delivered and is spooled, the third
+            # one is refused and dropped.
+            self.intake.statuses = [202, 503, 400]
+            reporter.submit(self.make_series(6))
+            nt.assert_equal(len(self.intake.posts), 1)
+            nt.assert_equal(len(spool), 1)
+
+            # It's replayed once the intake is back.
+            reporter.replay_spool()
+            nt.assert_equal(len(spool), 0)
+            values = [m['points'][0][1] for p in self.intake.posts
+                      for m in p[2]['series']]
+            nt.assert_equal(values, [0, 1, 2, 3])
+            reporter.close_connection()
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_replay_after_flush(self):
+        path = tempfile.mkdtemp()
+        try:
+            spool = Spool(path)
+            spool.append(json.dumps({'series': self.make_series(1)}))
+            aggregator = MetricsAggregator('myhost', 1)
+            reporter = Reporter(10, aggregator, self.url, chunk_retries=0,
+                spool=spool)
+
+            # The spool isn't replayed while the current flush fails.
+            aggregator.submit('my.counter:1|c')
+            time.sleep(1)
+            self.intake.statuses = [503]
+            reporter.flush()
+            nt.assert_equal(len(self.intake.posts), 0)
+            nt.assert_equal(len(spool), 1)
+
+            # Once it goes through, the spooled chunks (with the one of the
+            # failed flush) come after it, oldest first.
+            aggregator.submit('my.counter:1|c')
+            time.sleep(1)
+            reporter.flush()
+            reporter.close_connection()
+            metrics = [[m['metric'] for m in p[2]['series']]
+                       for p in self.intake.posts]
+            nt.assert_true('my.counter' in metrics[0])
+            nt.assert_equal(metrics[1], ['my.metric.0'])
+            nt.assert_equal(len(metrics), 3)
+            nt.assert_equal(len(spool), 0)
+        finally:
+            shutil.rmtree(path)
+
+    def test_unreachable_intake(self):
+        path = tempfile.mkdtemp()
+        try:
+            # A port nothing listens on.
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+
+            spool = Spool(path)
+            reporter = Reporter(10, None, 'http://127.0.0.1:%s' % port,
+                max_points_per_post=2, chunk_retries=2, spool=spool)
+            posts = []
+            post = reporter.post
+            reporter.post = lambda body: posts.append(body) or post(body)
+
+            # The first failure stops the flush, every chunk is spooled.
+            assert not reporter.submit_serialized(
+                [json.dumps(m) for m in self.make_series(6)])
+            nt.assert_equal(len(posts), 1)
+            records = []
+            spool.replay(lambda body: records.append(body) or True)
+            nt.assert_equal(len(records), 3)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestServer(object):
+
+    def test_udp_and_unix_socket(self):
+        path = tempfile.mkdtemp()
+        socket_path = os.path.join(path, 'dogstatsd.sock')
+        try:
+            aggregator = MetricsAggregator('myhost', 1)
+            server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path)
+            thread = threading.Thread(target=server.start)
+            thread.daemon = True
+            thread.start()
+
+            # Send everything within the same interval.
+            time.sleep(1 - time.time() % 1)
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.sendto('my.counter:1|c', server.socket.getsockname())
+            unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            unix.sendto('my.counter:2|c\nmy.gauge:3|g', socket_path)
+
+            time.sleep(1.5)
+            metrics = dict((m['metric'], m['points'][0][1])
+                           for m in aggregator.flush(False))
+            nt.assert_equal(metrics, {'my.counter': 3, 'my.gauge': 3})
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testReload(self):
+        journal = Journal(self.path, segment_size=100)
+        self.assertEquals(journal.load(), [])
+        ids = [journal.add('record %s' % i) for i in xrange(10)]
+        for tr_id in ids[:3] + ids[5:7]:
+            journal.ack(tr_id)
+        journal.close()
+
+        # Only the transactions not acknowledged come back, oldest first
+        journal = Journal(self.path, segment_size=100)
+        records = journal.load()
+        self.assertEquals(records, [(ids[i], 'record %s' % i)
+                                    for i in (3, 4, 7, 8, 9)])
+        self.assertEquals(len(journal), 5)
+
+        # New transactions get new ids
+        self.assertTrue(journal.add('record 10') > ids[-1])
+
+    def testSegmentsRemoved(self):
+        journal = Journal(self.path, segment_size=100)
+        journal.load()
+        ids = [journal.add('record %s' % i + 'x' * 20) for i in xrange(20)]
+        self.assertTrue(len(os.listdir(self.path)) > 2)
+
+        # The oldest segment can't go while it holds a transaction
+        for tr_id in ids[1:]:
+            journal.ack(tr_id)
+        self.assertTrue(len(os.listdir(self.path)) > 2)
+
+        journal.ack(ids[0])
+        self.assertEquals(len(os.listdir(self.path)), 1)
+        journal.close()
+        self.assertEquals(Journal(self.path).load(), [])
+
+    def testSizeCap(self):
+        journal = Journal(self.path, max_size=1000, segment_size=100)
+        journal.load()
+        ids = [journal.add('%02d' % i + 'x' * 38) for i in xrange(100)]
+        self.assertTrue(journal.size <= 1000)
+        self.assertTrue(journal.dropped > 0)
+        # Acknowledging a dropped transaction does nothing
+        journal.ack(ids[0])
+        journal.close()
+
+        # The newest transactions were kept
+        records = Journal(self.path, max_size=1000, segment_size=100).load()
+        self.assertEquals([r[:2] for _, r in records][-1], '99')
+        self.assertEquals([tr_id for tr_id, _ in records],
+                          ids[100 - len(records):])
+
+        # Transactions bigger than the journal aren't journaled
+        self.assertEquals(journal.add('x' * 1000), None)
+
+    def testCorruptRecord(self):
+        journal = Journal(self.path)
+        journal.load()
+        for i in xrange(3):
+            journal.add('record %s' % i)
+        journal.close()
+        # Truncate the last record, as a crash while writing it would.
+        name = os.path.join(self.path, os.listdir(self.path)[0])
+        f = open(name, 'r+b')
+        f.truncate(os.path.getsize(name) - 2)
+        f.close()
+
+        records = Journal(self.path).load()
+        self.assertEquals([r for _, r in records], ['record 0', 'record 1'])
+
+    def testKilled(self):
+        # Records written by a process killed before any sync are kept.
+        pid = os.fork()
+        if pid == 0:
+            journal = Journal(self.path, sync_interval=3600)
+            journal.load()
+            first = journal.add('first')
+            journal.add('second')
+            journal.ack(first)
+            os.kill(os.getpid(), signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+        records = Journal(self.path).load()
+        self.assertEquals([r for _, r in records], ['second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
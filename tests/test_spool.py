@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def replay_all(self, spool):
+        records = []
+        spool.replay(lambda r: records.append(r) or True)
+        return records
+
+    def testReplayOldestFirst(self):
+        spool = Spool(self.path, segment_size=100)
+        records = ['record %s' % i + 'x' * 20 for i in xrange(20)]
+        for record in records:
+            self.assertTrue(spool.append(record))
+        self.assertTrue(len(spool) > 1)
+
+        self.assertEquals(self.replay_all(spool), records)
+        # Replayed segments are removed.
+        self.assertEquals(len(spool), 0)
+        self.assertEquals(spool.size, 0)
+        self.assertEquals(os.listdir(self.path), [])
+
+    def testPartialReplay(self):
+        spool = Spool(self.path, segment_size=100)
+        for i in xrange(10):
+            spool.append(str(i))
+
+        # Stop at the 4th record, it's replayed again next time.
+        seen = []
+        def callback(record):
+            seen.append(record)
+            return len(seen) < 4
+        self.assertEquals(spool.replay(callback), 3)
+        spool.append('10')
+        self.assertEquals(self.replay_all(spool), [str(i) for i in xrange(3, 11)])
+
+    def testSizeCap(self):
+        spool = Spool(self.path, max_size=1000, segment_size=100)
+        for i in xrange(100):
+            spool.append('%02d' % i + 'x' * 38)
+        self.assertTrue(spool.size <= 1000)
+        self.assertTrue(spool.dropped > 0)
+
+        # The newest records were kept.
+        records = self.replay_all(spool)
+        self.assertEquals(records[-1][:2], '99')
+        self.assertEquals([int(r[:2]) for r in records],
+                          range(100 - len(records), 100))
+
+        # Records bigger than the spool are refused.
+        self.assertFalse(spool.append('x' * 1000))
+
+    def testReopen(self):
+        spool = Spool(self.path, segment_size=100)
+        for i in xrange(10):
+            spool.append(str(i))
+        spool.close()
+
+        spool = Spool(self.path, segment_size=100)
+        spool.append('10')
+        self.assertEquals(self.replay_all(spool), [str(i) for i in xrange(11)])
+
+    def testCorruptRecord(self):
+        spool = Spool(self.path)
+        for i in xrange(3):
+            spool.append('record %s' % i)
+        spool.close()
+        # Truncate the last record, as a crash while writing it would.
+        name = os.path.join(self.path, os.listdir(self.path)[0])
+        f = open(name, 'r+b')
+        f.truncate(os.path.getsize(name) - 2)
+        f.close()
+
+        spool = Spool(self.path)
+        self.assertEquals(self.replay_all(spool), ['record 0', 'record 1'])
+        self.assertEquals(len(spool), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
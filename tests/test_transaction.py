@@ -1,9 +1,19 @@
 import unittest
 from datetime import timedelta, datetime
+import shutil
+import tempfile
 import time
 
 from transaction import Transaction, TransactionManager
-from ddagent import MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY
+from journal import Journal
+from ddagent import MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, \
+    MAX_BATCH_SIZE, APIMetricTransaction, MetricTransaction, load_transaction, \
+    is_series_only, get_series_items
+from emitter import format_body
+from util import json
+
+# 2 msg/second
+THROTTLING_DELAY = timedelta(microseconds=1000000/2)
 
 class memTransaction(Transaction):
     def __init__(self, size, manager):
@@ -23,6 +33,44 @@ class memTransaction(Transaction):
 
         self._trManager.flush_next()
 
+class heldTransaction(Transaction):
+    """Waits for a response until completed by the test"""
+    def __init__(self, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = 100
+        self.flushed_at = None
+
+    def flush(self):
+        self.flushed_at = time.time()
+
+    def complete(self):
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+class postMixin(object):
+    """Records the bodies posted"""
+
+    def flush(self):
+        self.posts.append(self.get_data())
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+class postTransaction(postMixin, APIMetricTransaction):
+    posts = []
+
+class postIntakeTransaction(postMixin, MetricTransaction):
+    posts = []
+
+class nullManager(object):
+    """Accepts transactions without ever flushing them"""
+
+    def append(self, tr):
+        tr.set_id(1)
+
+    def flush(self):
+        pass
+
 class TestTransaction(unittest.TestCase):
 
     def setUp(self):
@@ -44,8 +92,8 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list, with
         # a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count,1)
 
         # Try to add one more
@@ -53,14 +101,14 @@ class TestTransaction(unittest.TestCase):
         trManager.append(tr)
 
         # At this point, transaction one (the oldest) should have been removed from the list 
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id,1)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -69,7 +117,7 @@ class TestTransaction(unittest.TestCase):
                 self.assertEqual(tr._flush_count,2)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
         
     def testThrottling(self):
@@ -91,6 +139,212 @@ class TestTransaction(unittest.TestCase):
         after = datetime.now()
         self.assertTrue( (after-before) > 3 * THROTTLING_DELAY)
             
+    def testEvictionOrder(self):
+        """Transactions to be flushed last are evicted first"""
+        trManager = TransactionManager(timedelta(seconds = 0), 100, timedelta(seconds=0))
+        trs = []
+        for i in xrange(4):
+            tr = memTransaction(25, trManager)
+            trManager.append(tr)
+            trs.append(tr)
+        # Postpone the second one
+        trs[1]._next_flush = datetime.now() + timedelta(seconds=60)
+        trManager._schedule(trs[1])
+
+        trManager.append(memTransaction(25, trManager))
+        ids = [tr.get_id() for tr in trManager.get_transactions()]
+        self.assertEqual(ids, [1, 3, 4, 5])
+
+        # Then the newest, as new transactions are due last
+        trManager.append(memTransaction(25, trManager))
+        ids = [tr.get_id() for tr in trManager.get_transactions()]
+        self.assertEqual(ids, [1, 3, 4, 6])
+
+    def testRescheduling(self):
+        """Failed transactions are flushed again, stale entries are dropped"""
+        trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        count = 100
+        trs = []
+        for i in xrange(count):
+            tr = memTransaction(100, trManager)
+            trManager.append(tr)
+            trs.append(tr)
+        time.sleep(0.01)
+
+        # Everything fails a few times, stale entries don't pile up
+        for flush_count in xrange(1, 4):
+            trManager.flush()
+            for tr in trs:
+                self.assertEqual(tr._flush_count, flush_count)
+            # Let them be due again
+            time.sleep(1)
+        self.assertTrue(len(trManager._flush_heap) + len(trManager._evict_heap)
+                        <= 4 * count + 64)
+
+        for tr in trs:
+            tr.is_flushable = True
+        trManager.flush()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._total_size, 0)
+
+    def testInFlightWindow(self):
+        """At most max_in_flight transactions wait for a response at once"""
+        trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0), max_in_flight=3)
+        trs = []
+        for i in xrange(5):
+            tr = heldTransaction(trManager)
+            trManager.append(tr)
+            trs.append(tr)
+        time.sleep(0.01)
+
+        trManager.flush()
+        sent = [tr for tr in trs if tr.flushed_at is not None]
+        self.assertEqual(len(sent), 3)
+
+        # A response lets the next one go
+        sent[0].complete()
+        self.assertEqual(len([tr for tr in trs if tr.flushed_at is not None]), 4)
+        while trManager._in_flight:
+            self.assertTrue(len(trManager._in_flight) <= 3)
+            trManager._transactions[min(trManager._in_flight)].complete()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._trs_to_flush, None)
+
+    def testTokenBucket(self):
+        """A burst goes out at once, then one transaction per delay"""
+        delay = timedelta(seconds=0.1)
+        trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE,
+            delay, max_in_flight=10, throttling_burst=5)
+        trManager._flush_without_ioloop = True
+        trs = []
+        for i in xrange(8):
+            tr = memTransaction(100, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+            trs.append(tr)
+        # Fill the bucket
+        time.sleep(0.6)
+
+        before = time.time()
+        trManager.flush()
+        elapsed = time.time() - before
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertTrue(0.25 < elapsed < 0.6, elapsed)
+
+    def testPayloadSize(self):
+        """Transactions cost the size of their compressed payload"""
+        MetricTransaction.set_tr_manager(nullManager())
+        try:
+            series = {'series': [{'metric': 'my.metric.%s' % i,
+                'points': [[1350000000, i]], 'tags': ['env:prod'],
+                'host': 'myhost'} for i in xrange(1000)]}
+            body = json.dumps(series)
+            tr = APIMetricTransaction(body)
+            self.assertEqual(tr.get_data(), body)
+            self.assertTrue(len(tr._payload) < tr.get_size() < len(body) / 4)
+
+            message = {'apiKey': 'key', 'collection_timestamp': 1350000000}
+            tr = MetricTransaction(message)
+            self.assertEqual(tr.get_data(), format_body(message, None))
+        finally:
+            MetricTransaction.set_tr_manager(None)
+
+    def testBatching(self):
+        """Queued series are merged into posts up to the batch size"""
+        trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        MetricTransaction.set_tr_manager(trManager)
+        postTransaction.posts = []
+        postIntakeTransaction.posts = []
+        try:
+            # Queue them without flushing
+            trManager.flush = lambda: None
+            bodies = [json.dumps({'series': [{'metric': 'my.metric.%s' % i,
+                'points': [[1350000000, j]], 'host': 'myhost'} for j in xrange(2)]})
+                for i in xrange(5)]
+            APIMetricTransaction.set_max_batch_size(3 * len(bodies[0]))
+            postTransaction(bodies[0])
+            # Intake transactions in between don't end the batch
+            message = {'apiKey': 'key', 'collection_timestamp': 1350000000}
+            postIntakeTransaction(message)
+            for body in bodies[1:3]:
+                postTransaction(body)
+            # Not only series, sent on its own
+            postTransaction(json.dumps({'series': [], 'foo': 'bar'}))
+            for body in bodies[3:]:
+                postTransaction(body)
+            del trManager.flush
+            time.sleep(0.01)
+
+            trManager.flush()
+            posts = [json.loads(post) for post in postTransaction.posts]
+            self.assertEqual(sorted(len(post['series']) for post in posts),
+                [0, 4, 6])
+            metrics = [series['metric'] for post in posts
+                       for series in post['series']]
+            self.assertEqual(sorted(set(metrics)),
+                ['my.metric.%s' % i for i in xrange(5)])
+            self.assertEqual(postIntakeTransaction.posts, [format_body(message, None)])
+            self.assertEqual(len(trManager.get_transactions()), 0)
+            self.assertEqual(trManager._total_size, 0)
+        finally:
+            MetricTransaction.set_tr_manager(None)
+            APIMetricTransaction.set_max_batch_size(MAX_BATCH_SIZE)
+
+    def testSeriesItems(self):
+        """Series only bodies are recognized, their items extracted as is"""
+        self.assertTrue(is_series_only('{"series": [{"metric": "a[0]"}]}'))
+        self.assertFalse(is_series_only('{"series": [], "foo": "bar"}'))
+        self.assertFalse(is_series_only('{"series": {}}'))
+        self.assertFalse(is_series_only('not json'))
+        self.assertEqual(get_series_items(' { "series" : [ {"metric": "a[0]"} ] } '),
+            '{"metric": "a[0]"}')
+        self.assertEqual(get_series_items('{"series":[ ]}'), '')
+
+    def testJournal(self):
+        """Transactions not sent are replayed after a restart"""
+        path = tempfile.mkdtemp()
+        try:
+            trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE,
+                timedelta(seconds=0), journal=Journal(path))
+            trManager._journal.load()
+            MetricTransaction.set_tr_manager(trManager)
+            postTransaction.posts = []
+            trManager.flush = lambda: None
+            bodies = [json.dumps({'series': [{'metric': 'my.metric.%s' % i,
+                'points': [[1350000000, i]]}]}) for i in xrange(4)]
+            for body in bodies[:3]:
+                postTransaction(body)
+            message = {'apiKey': 'key', 'collection_timestamp': 1350000000}
+            MetricTransaction(message)
+            postTransaction(bodies[3])
+            del trManager.flush
+            time.sleep(0.01)
+
+            # The 3 first are merged and sent, the others aren't due
+            for tr in trManager.get_transactions()[3:]:
+                tr._next_flush = datetime.now() + timedelta(seconds=60)
+                trManager._schedule(tr)
+            trManager.flush()
+            self.assertEqual(len(postTransaction.posts), 1)
+
+            # Restart, without closing the journal as after a crash
+            trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE,
+                timedelta(seconds=0), journal=Journal(path))
+            MetricTransaction.set_tr_manager(trManager)
+            trManager.replay_journal(load_transaction)
+            trs = trManager.get_transactions()
+            self.assertEqual([tr.__class__ for tr in trs],
+                [MetricTransaction, APIMetricTransaction])
+            self.assertEqual(trs[0].get_data(), format_body(message, None))
+            self.assertEqual(trs[1].get_data(), bodies[3])
+            self.assertEqual(trs[1]._batch_size, len(bodies[3]))
+            # Not journaled twice
+            self.assertEqual(len(trManager._journal), 2)
+        finally:
+            MetricTransaction.set_tr_manager(None)
+            shutil.rmtree(path)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,8 @@
 import sys
 import time
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
 
 import tornado.ioloop
 
@@ -11,6 +11,14 @@ def plural(count):
         return "s"
     return ""
 
+def total_seconds(td):
+    # Python 2.7 has this built in, python < 2.7 don't...
+    if hasattr(td,'total_seconds'):
+        return td.total_seconds()
+    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+
+EPOCH = datetime(1970, 1, 1)
+
 class ImplementationError(Exception): pass
 
 class Transaction(object):
@@ -21,6 +29,7 @@ class Transaction(object):
         self._error_count = 0
         self._next_flush = datetime.now()        
         self._size = None
+        self._journal_ids = [] # Ids of the journal records to acknowledge
 
     def get_id(self):
         return self._id
@@ -57,6 +66,20 @@ class Transaction(object):
     def time_to_flush(self,now = datetime.now()):
         return self._next_flush < now
 
+    def get_journal_record(self):
+        """Return the string to journal the transaction with, to build it
+           back after a restart, or None not to journal it"""
+        return None
+
+    def is_mergeable(self):
+        """Whether other transactions can be merged into this one"""
+        return False
+
+    def merge(self, tr):
+        """Try to add another transaction to this one, to be sent together.
+           Return True if it was merged."""
+        return False
+
     def flush(self):
         raise ImplementationError("To be implemented in a subclass")
 
@@ -64,27 +87,100 @@ class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
+                 max_in_flight=1, throttling_burst=1, journal=None):
 
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max_in_flight
 
         self._flush_without_ioloop = False # usefull for tests
 
-        self._transactions = [] #List of all non commited transactions
+        self._journal = journal # Optional, keeps the transactions on disk
+
+        self._transactions = {} # All non commited transactions, by id
         self._total_count = 0 # Maintain size/count not to recompute it everytime
         self._total_size = 0 
 
+        # Heaps of (next flush, id) to find the transactions due for a flush,
+        # and of (-next flush, id) to find the ones to evict first when the
+        # queue is full (latest next flush, then oldest). Entries aren't
+        # removed when a transaction completes or is rescheduled, they're
+        # skipped when they no longer match it.
+        self._flush_heap = []
+        self._evict_heap = []
+
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.now() # Last flush (for throttling)
+        self._in_flight = set() # Ids of the transactions sent, waiting for a response
+        self._flush_pending = False # Whether a flush_next is scheduled
+
+        # Token bucket for throttling: a token is added every throttling
+        # delay, up to the burst, and each transaction sent takes one.
+        # It starts empty, the first transaction waits for a delay.
+        delay = total_seconds(throttling_delay)
+        self._token_rate = 1.0 / delay if delay > 0 else None # None: no throttling
+        self._token_burst = max(throttling_burst, 1)
+        self._tokens = 0.0
+        self._tokens_updated = time.time()
 
     def get_transactions(self):
-        return self._transactions
+        return [self._transactions[tr_id] for tr_id in sorted(self._transactions)]
+
+    def _schedule(self, tr):
+        """Index the transaction by its next flush time"""
+        next_flush = total_seconds(tr.get_next_flush() - EPOCH)
+        heapq.heappush(self._flush_heap, (next_flush, tr.get_id()))
+        heapq.heappush(self._evict_heap, (-next_flush, tr.get_id()))
+
+        # Don't let stale entries pile up
+        if len(self._flush_heap) + len(self._evict_heap) > 4 * len(self._transactions) + 64:
+            self._compact()
+
+    def _is_current(self, next_flush, tr_id):
+        tr = self._transactions.get(tr_id)
+        return tr is not None and \
+            total_seconds(tr.get_next_flush() - EPOCH) == next_flush
+
+    def _compact(self):
+        """Drop the stale heap entries"""
+        self._flush_heap = [(t, i) for t, i in self._flush_heap
+                            if self._is_current(t, i)]
+        heapq.heapify(self._flush_heap)
+        self._evict_heap = [(t, i) for t, i in self._evict_heap
+                            if self._is_current(-t, i)]
+        heapq.heapify(self._evict_heap)
+
+    def _remove(self, tr_id):
+        tr = self._transactions.pop(tr_id, None)
+        if tr is not None:
+            self._total_count = self._total_count - 1
+            self._total_size = self._total_size - tr.get_size()
+            if self._journal is not None:
+                for journal_id in tr._journal_ids:
+                    self._journal.ack(journal_id)
+        return tr
+
+    def replay_journal(self, load):
+        """Queue the transactions the journal holds from a previous run,
+           `load` builds a transaction back from its journal record"""
+        count = 0
+        for journal_id, record in self._journal.load():
+            try:
+                tr = load(record)
+            except Exception, e:
+                logging.exception(e)
+                self._journal.ack(journal_id)
+                continue
+            tr._journal_ids.append(journal_id)
+            self.append(tr)
+            count = count + 1
+        if count > 0:
+            logging.info("Replaying %s transaction%s from the journal" % (count, plural(count)))
 
     def print_queue_stats(self):
         logging.info("Queue size: at %s, %s transaction(s), %s KB" % 
@@ -107,18 +203,26 @@ class TransactionManager(object):
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             logging.warn("Queue is too big, removing old messages...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    logging.warn("Removing transaction %s from queue" % tr2.get_id())
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
+            evict_heap = self._evict_heap
+            while evict_heap and (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                next_flush, tr_id = heapq.heappop(evict_heap)
+                if self._is_current(-next_flush, tr_id):
+                    logging.warn("Removing transaction %s from queue" % tr_id)
+                    self._remove(tr_id)
+
+        # Journal it before it's acknowledged
+        if self._journal is not None and not tr._journal_ids:
+            record = tr.get_journal_record()
+            if record is not None:
+                journal_id = self._journal.add(record)
+                if journal_id is not None:
+                    tr._journal_ids.append(journal_id)
 
         # Done
-        self._transactions.append(tr)
+        self._transactions[tr.get_id()] = tr
         self._total_count = self._total_count + 1
         self._total_size = self._total_size + tr_size
+        self._schedule(tr)
 
         logging.info("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
@@ -130,11 +234,16 @@ class TransactionManager(object):
             return
 
         to_flush = []
-        # Do we have something to do ?
-        now = datetime.now()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        # Do we have something to do ? Transactions are taken off the flush
+        # heap, they go back to it if they fail.
+        now = total_seconds(datetime.now() - EPOCH)
+        flush_heap = self._flush_heap
+        while flush_heap and flush_heap[0][0] < now:
+            next_flush, tr_id = heapq.heappop(flush_heap)
+            if self._is_current(next_flush, tr_id):
+                to_flush.append(self._transactions[tr_id])
+
+        to_flush = self._coalesce(to_flush)
 
         count = len(to_flush)
         if count > 0:
@@ -142,51 +251,105 @@ class TransactionManager(object):
             self._trs_to_flush = to_flush
             self.flush_next()
 
+    def _coalesce(self, trs):
+        """Merge the transactions which can be sent together: the merged
+           ones leave the queue, they now succeed or fail with the one they
+           were merged into."""
+        coalesced = []
+        # The last transaction others can be merged into, the ones which
+        # can't be merged in between don't end the batch
+        target = None
+        for tr in trs:
+            if target is not None:
+                target_size = target.get_size()
+                if target.merge(tr):
+                    # Its journal records are acknowledged with the target
+                    target._journal_ids.extend(tr._journal_ids)
+                    tr._journal_ids = []
+                    self._remove(tr.get_id())
+                    self._total_size = self._total_size - target_size + target.get_size()
+                    continue
+            coalesced.append(tr)
+            if tr.is_mergeable():
+                target = tr
+        return coalesced
+
+    def _take_token(self):
+        """Take a token to send a transaction. Return 0 if one was taken,
+           else the delay in seconds before one is available"""
+        if self._token_rate is None:
+            return 0
+
+        now = time.time()
+        self._tokens = min(self._token_burst,
+            self._tokens + (now - self._tokens_updated) * self._token_rate)
+        self._tokens_updated = now
+
+        if self._tokens >= 1:
+            self._tokens = self._tokens - 1
+            return 0
+        return (1 - self._tokens) / self._token_rate
+
+    def _flush_timeout(self):
+        self._flush_pending = False
+        self.flush_next()
+
     def flush_next(self):
+        """Send transactions until the in-flight window is full, or we have
+           to wait for a token. Called again when a response comes in."""
+
+        if self._trs_to_flush is None:
+            return
+
+        while len(self._trs_to_flush) > 0 and \
+                len(self._in_flight) < self._MAX_IN_FLIGHT:
 
-        if len(self._trs_to_flush) > 0:
-
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.now()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
-
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.now()
-                logging.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    logging.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+            delay = self._take_token()
+            if delay > 0:
                 # Wait a little bit more
                 if  tornado.ioloop.IOLoop.instance().running():
-                    tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                    if not self._flush_pending:
+                        self._flush_pending = True
+                        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                            self._flush_timeout)
+                    return
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING                    
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                    continue
+                else:
+                    return
+
+            tr = self._trs_to_flush.pop()
+            self._in_flight.add(tr.get_id())
+            logging.debug("Flushing transaction %d" % tr.get_id())
+            try:
+                tr.flush()
+            except Exception,e :
+                logging.exception(e)
+                self.tr_error(tr)
+
+            # A synchronous response may have ended the flush already
+            if self._trs_to_flush is None:
+                return
+
+        if len(self._trs_to_flush) == 0 and len(self._in_flight) == 0:
             self._trs_to_flush = None
 
     def tr_error(self,tr):
+        self._in_flight.discard(tr.get_id())
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        if tr.get_id() in self._transactions:
+            self._schedule(tr)
         logging.info("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()), 
            tr.get_next_flush()))
 
     def tr_success(self,tr):
         logging.info("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count = self._total_count - 1
-        self._total_size = self._total_size - tr.get_size()
+        self._in_flight.discard(tr.get_id())
+        self._remove(tr.get_id())
         self.print_queue_stats()
 
 
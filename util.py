@@ -3,6 +3,7 @@ import os
 import platform
 import signal
 import sys
+import zlib
 
 # We need to return the data using JSON. As of Python 2.6+, there is a core JSON
 # module. We have a 2.4/2.5 compatible lib included with the agent but if we're
@@ -23,6 +24,17 @@ else:
             return minjson.safeRead(data)
 
 
+# zlib window bits producing/reading gzip framing.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data):
+    return zlib.decompress(data, GZIP_WBITS)
+
+
 def headers(agentConfig):
     # Build the request headers
     return {